@@ -0,0 +1,48 @@
+# benchmarks/compare.py
+
+"""
+Compares two result files from benchmarks.run stage by stage.
+
+    python -m benchmarks.compare before.json after.json --threshold 1.10
+
+Exits with status 1 when any stage got slower than `threshold` times the baseline.
+"""
+
+import argparse
+import json
+import sys
+
+def load(path):
+    with open(path) as f:
+        data = json.load(f)
+    return data['meta'], {(r['rows'], r['stage']): r for r in data['results']}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.compare")
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=1.10, help="Slowdown ratio reported as a regression.")
+    args = parser.parse_args(argv)
+
+    base_meta, base = load(args.baseline)
+    cand_meta, cand = load(args.candidate)
+    print(f"baseline  {base_meta.get('commit')}  {base_meta.get('timestamp')}")
+    print(f"candidate {cand_meta.get('commit')}  {cand_meta.get('timestamp')}")
+    print(f"{'rows':>9}  {'stage':<24} {'baseline':>10} {'candidate':>10} {'ratio':>7}  {'peak MiB':>17}")
+
+    regressions = 0
+    for key in sorted(base.keys() & cand.keys()):
+        b, c = base[key], cand[key]
+        ratio = c['seconds'] / b['seconds'] if b['seconds'] else float('inf')
+        memory = ""
+        if b.get('peak_bytes') is not None and c.get('peak_bytes') is not None:
+            memory = f"{b['peak_bytes'] / 1024 ** 2:8.1f}->{c['peak_bytes'] / 1024 ** 2:<8.1f}"
+        flag = "  REGRESSION" if ratio > args.threshold else ""
+        regressions += bool(flag)
+        print(f"{key[0]:>9,}  {key[1]:<24} {b['seconds']:>9.3f}s {c['seconds']:>9.3f}s {ratio:>7.2f}  {memory:>17}{flag}")
+    for key in sorted(base.keys() ^ cand.keys()):
+        print(f"{key[0]:>9,}  {key[1]:<24} only in {'baseline' if key in base else 'candidate'}")
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,213 @@
+# benchmarks/run.py
+
+"""
+Times each pipeline stage on synthetic cohorts and writes the results as JSON.
+
+    python -m benchmarks.run                                # 1k, 10k, 100k and 1M students
+    python -m benchmarks.run --sizes 1000 10000 --out before.json
+    python -m benchmarks.compare before.json after.json
+
+Stages run once for timing and, unless --no-memory is given, once more under tracemalloc for the
+peak allocation (tracemalloc slows Python-heavy stages, so the two are never mixed). PDF and email
+stages render/send at most --pdf-limit / --email-limit students per size; their throughput is per report.
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from config import SENSITIVITY
+from benchmarks.synthetic import generate_cohort, write_cohort
+from utils.data_processing import get_parse_cache, load_and_merge_files
+from utils.email_sender import EmailJob, send_bulk_emails
+from utils.expert_system import generate_dropout_report, sweep_thresholds
+from utils.peer_stats import compute_peer_stats, get_peer_metrics
+from utils.predictions import assign_risk_levels, get_ml_predictions
+from utils.reporting import generate_ai_pdf, generate_rule_based_pdf
+from utils.runtime import RaisingReporter, set_reporter
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SIZES = [1_000, 10_000, 100_000, 1_000_000]
+
+def _git(*args):
+    try:
+        return subprocess.run(['git', *args], cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def environment():
+    return {
+        'commit': _git('rev-parse', 'HEAD'),
+        'dirty': bool(_git('status', '--porcelain', '--untracked-files=no')),
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+    }
+
+def measure(stage, rows, items, func, track_memory=True):
+    """Runs `func` once timed and, with `track_memory`, once more under tracemalloc. Returns (result row, value)."""
+    gc.collect()
+    start = time.perf_counter()
+    value = func()
+    seconds = time.perf_counter() - start
+    peak = None
+    if track_memory:
+        del value
+        gc.collect()
+        tracemalloc.start()
+        value = func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    row = {'rows': rows, 'stage': stage, 'items': items, 'seconds': seconds,
+           'items_per_second': items / seconds if seconds else None, 'peak_bytes': peak}
+    print(f"{rows:>9,}  {stage:<24} {seconds:9.3f}s  {row['items_per_second'] or 0:>12,.0f}/s"
+          + (f"  {peak / 1024 ** 2:9.1f} MiB" if peak is not None else ""), flush=True)
+    return row, value
+
+class SMTPSink:
+    """A local SMTP server that accepts and discards everything (needs aiosmtpd)."""
+    def __init__(self):
+        from aiosmtpd.controller import Controller
+
+        class Handler:
+            def __init__(self):
+                self.received = 0
+
+            async def handle_DATA(self, server, session, envelope):
+                self.received += 1
+                return '250 OK'
+
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            self.port = s.getsockname()[1]
+        self.handler = Handler()
+        self._controller = Controller(self.handler, hostname='127.0.0.1', port=self.port)
+
+    def __enter__(self):
+        self._controller.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._controller.stop()
+
+def _render_all(generator, students, peer_stats, group_column):
+    return [generator(student, get_peer_metrics(peer_stats, group_column, student[group_column])) for student in students]
+
+def benchmark_size(n, model, workdir, args, sink=None):
+    track = not args.no_memory
+    results = []
+    paths = write_cohort(generate_cohort(n, seed=args.seed), workdir, n_files=args.files)
+
+    def load():
+        get_parse_cache().clear()  # time parsing, not cache hits
+        handles = [open(path, 'rb') for path in paths]
+        try:
+            return load_and_merge_files(handles, use_schema=True)
+        finally:
+            for handle in handles:
+                handle.close()
+
+    row, data = measure('load_and_merge_files', n, n, load, track); results.append(row)
+    row, scored = measure('get_ml_predictions', n, n, lambda: get_ml_predictions(model, data), track); results.append(row)
+    probabilities = scored['dropout_probability']
+    row, levels = measure('assign_risk_levels', n, n, lambda: assign_risk_levels(probabilities), track); results.append(row)
+    row, expert = measure('generate_dropout_report', n, n, lambda: generate_dropout_report(data), track); results.append(row)
+    grid = {name: range(start, stop + 1, step) for name, (start, stop, step) in SENSITIVITY['DEFAULT_SWEEP'].items()}
+    row, _ = measure('sweep_thresholds', n, n, lambda: sweep_thresholds(data, grid), track); results.append(row)
+
+    df = pd.concat([scored, expert], axis=1)
+    df['ai_risk_level'] = levels
+    row, peer_stats = measure('compute_peer_stats', n, n, lambda: compute_peer_stats(df), track); results.append(row)
+
+    sample = df.iloc[:min(n, args.pdf_limit)]
+    students = [student for _, student in sample.iterrows()]
+    row, ai_pdfs = measure('generate_ai_pdf', n, len(students),
+                           lambda: _render_all(generate_ai_pdf, students, peer_stats, 'ai_risk_level'), track)
+    results.append(row)
+    row, _ = measure('generate_rule_based_pdf', n, len(students),
+                     lambda: _render_all(generate_rule_based_pdf, students, peer_stats, 'expert_status'), track)
+    results.append(row)
+
+    if sink is not None:
+        n_emails = min(n, args.email_limit)
+        settings = {'SMTP_HOST': '127.0.0.1', 'SMTP_PORT': sink.port, 'USE_STARTTLS': False,
+                    'GLOBAL_RATE': 0, 'PER_CONNECTION_RATE': 0}
+
+        def send():
+            jobs = (EmailJob(f"student{i}@example.com", "Benchmark report", "Hello,", ai_pdfs[i % len(ai_pdfs)],
+                             f"Student {i}", 'AI_Based') for i in range(n_emails))
+            return send_bulk_emails(jobs, 'benchmark@example.com', '', settings=settings)
+        row, sent = measure('send_bulk_emails', n, n_emails, send, track)
+        failed = sum(not r.success for r in sent)
+        if failed:
+            row['failed'] = failed
+        results.append(row)
+    return results
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run", description="Benchmark the dashboard pipeline on synthetic cohorts.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--model', default=os.path.join(REPO_ROOT, 'logistic_model.pkl'))
+    parser.add_argument('--files', type=int, default=2, help="Number of CSV files each cohort is split into.")
+    parser.add_argument('--pdf-limit', type=int, default=200)
+    parser.add_argument('--email-limit', type=int, default=200)
+    parser.add_argument('--no-email', action='store_true', help="Skip the SMTP stage.")
+    parser.add_argument('--no-memory', action='store_true', help="Skip the tracemalloc pass.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help="Results file; defaults to benchmarks/results/<commit>_<time>.json.")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    set_reporter(RaisingReporter())
+    model = joblib.load(args.model)
+    meta = {**environment(), 'model': os.path.basename(args.model), 'sizes': args.sizes,
+            'pdf_limit': args.pdf_limit, 'email_limit': args.email_limit, 'memory': not args.no_memory}
+
+    sink = None
+    if not args.no_email:
+        try:
+            sink = SMTPSink()
+        except ImportError:
+            print("aiosmtpd is not installed; skipping the email stage.", file=sys.stderr)
+    meta['email'] = sink is not None
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        if sink is not None:
+            sink.__enter__()
+        try:
+            for n in args.sizes:
+                results.extend(benchmark_size(n, model, os.path.join(workdir, str(n)), args, sink))
+        finally:
+            if sink is not None:
+                sink.__exit__(None, None, None)
+
+    out = args.out
+    if out is None:
+        stamp = datetime.now().strftime('%Y%m%dT%H%M%S')
+        out = os.path.join(REPO_ROOT, 'benchmarks', 'results', f"{(meta['commit'] or 'nogit')[:10]}_{stamp}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=2)
+    print(f"Wrote {out}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,58 @@
+# benchmarks/synthetic.py
+
+"""
+Synthetic student cohorts with the columns and rough distributions of the real class files.
+Scores are driven by a latent ability so that tests, assignments and study hours correlate, and a
+share of students slips between the previous and current term so the expert rules all fire.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+COLUMNS = ['Student Name', 'student_email', 'gender', 'attendance', 'current_test_score', 'current_assignment_score',
+           'previous_test_score', 'previous_assignment_score', 'fees', 'Average Study Hour']
+
+def _scores(values):
+    return np.clip(np.rint(values), 0, 100).astype(np.int16)
+
+def generate_cohort(n, seed=0, missing_email_rate=0.05):
+    """A DataFrame of `n` students in the layout of class_A_data.csv."""
+    rng = np.random.default_rng(seed)
+    ability = rng.normal(70, 15, n)
+    engagement = rng.normal(0, 1, n)
+    declining = rng.random(n) < 0.15  # students whose results drop this term
+
+    previous_test = ability + rng.normal(0, 8, n)
+    previous_assignment = ability + 4 + rng.normal(0, 8, n)
+    drift = np.where(declining, rng.normal(-25, 10, n), rng.normal(2, 6, n))
+    current_test = previous_test + drift + rng.normal(0, 5, n)
+    current_assignment = previous_assignment + drift * 0.8 + rng.normal(0, 5, n)
+    attendance = 100 - rng.gamma(2.0, 6.0, n) * (1.6 - 0.4 * np.tanh(engagement)) - declining * rng.uniform(0, 30, n)
+    study_hours = np.clip(np.rint(ability / 20 + engagement + rng.normal(-0.5, 1, n)), 0, 8)
+
+    ids = np.arange(n)
+    emails = pd.Series([f"student{i}@example.com" for i in ids], dtype=object)
+    emails[rng.random(n) < missing_email_rate] = None
+    return pd.DataFrame({
+        'Student Name': [f"Student {i:07d}" for i in ids],
+        'student_email': emails,
+        'gender': rng.choice(['Male', 'Female'], n),
+        'attendance': np.clip(np.rint(attendance), 0, 100).astype(np.int16),
+        'current_test_score': _scores(current_test),
+        'current_assignment_score': _scores(current_assignment),
+        'previous_test_score': _scores(previous_test),
+        'previous_assignment_score': _scores(previous_assignment),
+        'fees': (rng.random(n) < 0.85).astype(np.int8),
+        'Average Study Hour': study_hours.astype(np.int8),
+    }, columns=COLUMNS)
+
+def write_cohort(df, directory, n_files=2, prefix='class'):
+    """Splits `df` into `n_files` CSVs like the per-class uploads and returns their paths."""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i, part in enumerate(np.array_split(np.arange(len(df)), n_files)):
+        path = os.path.join(directory, f"{prefix}_{chr(ord('A') + i)}_{len(df)}.csv")
+        df.iloc[part].to_csv(path, index=False)
+        paths.append(path)
+    return paths
@@ -0,0 +1,271 @@
+# cli.py
+
+"""
+Headless entry point for the scoring/reporting pipeline, for nightly jobs and scripts.
+
+    python cli.py calibrate --data class_A.csv --model logistic_model.pkl
+    python cli.py score  --data class_A.csv class_B.xlsx --model logistic_model.pkl --out predictions.csv --save-history
+    python cli.py report --predictions predictions.csv --type rule --out-dir reports/
+    python cli.py send   --data class_A.csv --model logistic_model.pkl --type ai
+    python cli.py export --predictions predictions.csv --type ai --format zip --out reports.zip
+    python cli.py sweep  --data class_A.csv --vary MARKS_FAILING=30:50 --vary ATTENDANCE_POOR=65:85:5 --out sweep.csv
+
+Streamlit and Plotly are never imported. Email credentials come from the SENDER_EMAIL and
+SENDER_PASSWORD environment variables.
+"""
+
+import argparse
+import logging
+import os
+import sys
+
+from utils.runtime import PipelineError, logger
+from utils.instrumentation import export_run, start_run
+
+REPORT_PREFIXES = {'ai': 'AI_Based', 'rule': 'Rule_Based'}
+REPORT_NAMES = {'ai': 'AI-Based Report', 'rule': 'Rule-Based Report'}
+
+def _read_table(path):
+    import pandas as pd
+    return pd.read_parquet(path) if path.endswith('.parquet') else pd.read_csv(path)
+
+def _write_table(df, path):
+    if path.endswith('.parquet'):
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+
+def _load_data(paths):
+    from config import HISTORY
+    from utils.data_processing import load_and_merge_files
+    handles = [open(path, 'rb') for path in paths]
+    try:
+        data = load_and_merge_files(handles, use_schema=True, source_column=HISTORY['CLASS_COLUMN'])
+    finally:
+        for handle in handles:
+            handle.close()
+    if data is None:
+        raise PipelineError("No student data could be loaded.")
+    return data
+
+def _scored_frame(args):
+    """Scores --data with --model, or reads a frame previously written by `score` via --predictions."""
+    if args.predictions:
+        df = _read_table(args.predictions)
+    else:
+        if not (args.data and args.model):
+            raise PipelineError("Pass --predictions, or both --data and --model.")
+        from utils.data_processing import load_model_with_info
+        from utils.model_registry import check_compatibility
+        from utils.pipeline import score_cohort
+        data = _load_data(args.data)
+        with open(args.model, 'rb') as model_file:
+            model, info = load_model_with_info(model_file)
+        problems = check_compatibility(info, data.columns)
+        if problems:
+            raise PipelineError("; ".join(problems))
+        df = score_cohort(model, data)
+        logger.info("Scored %d students.", len(df))
+    if 'Student_Name' not in df.columns and 'Student Name' in df.columns:
+        df = df.rename(columns={'Student Name': 'Student_Name'})
+    return df
+
+def _reports(args, df):
+    from utils.peer_stats import compute_peer_stats
+    from utils.reporting import generate_reports_parallel
+    # Peer groups always span the whole cohort, as in the dashboard.
+    return generate_reports_parallel(df, args.type, compute_peer_stats(df), max_workers=args.workers, chart_backend=args.chart_backend)
+
+def cmd_score(args):
+    df = _scored_frame(args)
+    _write_table(df, args.out)
+    logger.info("Wrote %s", args.out)
+    if args.save_history:
+        from utils.history import get_history_store
+        from utils.outbox import current_term
+        run_id = get_history_store().append(df, args.term or current_term())
+        logger.info("Saved run %s to the history store.", run_id)
+
+def cmd_calibrate(args):
+    from utils.data_processing import load_model_with_info
+    from utils.model_registry import get_model_registry
+    from utils.predictions import get_ml_predictions
+    data = _load_data(args.data)
+    with open(args.model, 'rb') as model_file:
+        model, info = load_model_with_info(model_file)
+    try:
+        cuts = get_model_registry().calibrate(model, info, get_ml_predictions(model, data)['dropout_probability'], args.method)
+    except ValueError as e:
+        raise PipelineError(str(e))
+    logger.info("Risk band cut-points %s saved with model %s in the registry.", ", ".join(f"{c:.4f}" for c in cuts), info.sha256[:12])
+    if args.out:
+        import joblib
+        joblib.dump(model, args.out)
+        logger.info("Wrote the calibrated model to %s", args.out)
+
+def cmd_report(args):
+    df = _scored_frame(args)
+    os.makedirs(args.out_dir, exist_ok=True)
+    count = 0
+    from utils.reporting import report_file_name
+    for student, pdf_bytes in _reports(args, df):
+        with open(os.path.join(args.out_dir, report_file_name(args.type, student['Student_Name'])), 'wb') as f:
+            f.write(pdf_bytes)
+        count += 1
+    logger.info("Wrote %d reports to %s", count, args.out_dir)
+
+def cmd_export(args):
+    from utils.peer_stats import compute_peer_stats
+    from utils.reporting import write_merged_pdf, write_reports_zip
+    df = _scored_frame(args)
+    peer_stats = compute_peer_stats(df)
+    def progress(n_done, student):
+        if n_done % 100 == 0:
+            logger.info("Rendered %d of %d reports", n_done, len(df))
+    # '-' streams to stdout, so e.g. a ZIP can be piped onwards while later reports are still rendering.
+    fh = sys.stdout.buffer if args.out == '-' else open(args.out, 'wb')
+    try:
+        if args.format == 'zip':
+            write_reports_zip(df, args.type, fh, peer_stats, progress, max_workers=args.workers, chart_backend=args.chart_backend)
+        else:
+            write_merged_pdf(df, args.type, fh, peer_stats, progress, chart_backend=args.chart_backend)
+        fh.flush()
+    finally:
+        if fh is not sys.stdout.buffer:
+            fh.close()
+    logger.info("Exported %d reports to %s", len(df), args.out)
+
+def _threshold_range(spec):
+    """Parses NAME=START:STOP[:STEP] (STOP inclusive) into (NAME, values)."""
+    import numpy as np
+    try:
+        name, bounds = spec.split('=')
+        start, stop, step = (list(map(float, bounds.split(':'))) + [1])[:3]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected NAME=START:STOP[:STEP], got '{spec}'")
+    values = np.arange(start, stop + step / 2, step)
+    return name, values.astype(int) if (values == np.round(values)).all() else values
+
+def cmd_sweep(args):
+    from utils.expert_system import sweep_thresholds
+    data = _read_table(args.predictions) if args.predictions else _load_data(args.data or [])
+    try:
+        result = sweep_thresholds(data, dict(args.vary), field=args.field)
+    except ValueError as e:
+        raise PipelineError(str(e))
+    _write_table(result, args.out)
+    logger.info("Wrote %d threshold combinations to %s", len(result), args.out)
+
+def cmd_send(args):
+    import pandas as pd
+    from utils.email_sender import EmailJob, get_sender_credentials, send_bulk_emails
+    sender_email, sender_password = get_sender_credentials()
+    if sender_email is None:
+        raise PipelineError("Set SENDER_EMAIL and SENDER_PASSWORD to send reports.")
+    df = _scored_frame(args)
+    has_email = df['student_email'].notna() if 'student_email' in df.columns else pd.Series(False, index=df.index)
+    for name in df.loc[~has_email, 'Student_Name']:
+        logger.warning("Skipping %s: Email ID does not exist.", name)
+
+    prefix, report_name = REPORT_PREFIXES[args.type], REPORT_NAMES[args.type]
+    def jobs():
+        for student, pdf_bytes in _reports(args, df[has_email]):
+            name = student['Student_Name']
+            subject = f"Your Student Performance Report ({prefix.replace('_', ' ')})"
+            body = f"Hello {name},\n\nPlease find your attached {report_name.lower()}.\n\nBest regards,"
+            yield EmailJob(student['student_email'], subject, body, pdf_bytes, name, prefix)
+
+    settings = {'SMTP_HOST': args.smtp_host, 'SMTP_PORT': args.smtp_port} if args.smtp_host else {}
+    if args.no_starttls:
+        settings['USE_STARTTLS'] = False
+    results = send_bulk_emails(jobs(), sender_email, sender_password, settings=settings)
+    failed = [r for r in results if not r.success]
+    for r in failed:
+        logger.error("Failed to send to %s <%s>: %s", r.student_name, r.recipient_email, r.error)
+    if args.out:
+        _write_table(pd.DataFrame([vars(r) for r in results]), args.out)
+    logger.info("Sent %d of %d reports.", len(results) - len(failed), len(results))
+    return 1 if failed else 0
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="cli.py", description="Score students and generate/send risk reports without the dashboard.")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('--metrics-jsonl', help="Append per-stage timings of this run to a JSON-lines file.")
+    parser.add_argument('--metrics-prom', help="Write per-stage timings in Prometheus text format (e.g. for a textfile collector).")
+    parser.add_argument('--trace-memory', action='store_true', help="Record tracemalloc peaks per stage (slower).")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def add_inputs(p):
+        p.add_argument('--data', nargs='+', help="Student data files (.csv/.xlsx) to merge and score.")
+        p.add_argument('--model', help="Trained model file (.joblib/.pkl).")
+        p.add_argument('--predictions', help="Skip scoring and use a frame written by `score` (.csv/.parquet).")
+
+    def add_report_options(p):
+        p.add_argument('--type', choices=sorted(REPORT_PREFIXES), default='ai')
+        p.add_argument('--workers', type=int, default=None)
+        p.add_argument('--chart-backend', choices=['matplotlib', 'vector'], default=None)
+
+    score = commands.add_parser('score', help="Score students and write the combined predictions.")
+    add_inputs(score)
+    score.add_argument('--out', required=True, help="Output .csv or .parquet file.")
+    score.add_argument('--save-history', action='store_true', help="Also append the run to the history store (needs pyarrow).")
+    score.add_argument('--term', help="History term; defaults to the current half-year.")
+    score.set_defaults(func=cmd_score)
+
+    calibrate = commands.add_parser('calibrate', help="Fit AI risk band cut-points on a reference cohort and store them with the model in the registry.")
+    calibrate.add_argument('--data', nargs='+', required=True)
+    calibrate.add_argument('--model', required=True)
+    calibrate.add_argument('--method', choices=['jenks', 'quantile'], default=None)
+    calibrate.add_argument('--out', help="Also write a copy of the calibrated model to this file.")
+    calibrate.set_defaults(func=cmd_calibrate)
+
+    report = commands.add_parser('report', help="Write one PDF report per student.")
+    add_inputs(report)
+    add_report_options(report)
+    report.add_argument('--out-dir', required=True)
+    report.set_defaults(func=cmd_report)
+
+    export = commands.add_parser('export', help="Write every student's report into one ZIP or one merged PDF.")
+    add_inputs(export)
+    add_report_options(export)
+    export.add_argument('--format', choices=['zip', 'pdf'], default='zip')
+    export.add_argument('--out', required=True, help="Output file, or '-' for stdout.")
+    export.set_defaults(func=cmd_export)
+
+    sweep = commands.add_parser('sweep', help="Count expert-system outcomes over a grid of threshold values.")
+    sweep.add_argument('--data', nargs='+', help="Student data files (.csv/.xlsx).")
+    sweep.add_argument('--predictions', help="Use a frame written by `score` instead (.csv/.parquet).")
+    sweep.add_argument('--vary', type=_threshold_range, action='append', required=True, metavar='NAME=START:STOP[:STEP]',
+                       help="A THRESHOLDS key and the inclusive range to try; repeat for a grid.")
+    sweep.add_argument('--field', choices=['status', 'reason'], default='status')
+    sweep.add_argument('--out', required=True, help="Output .csv or .parquet file.")
+    sweep.set_defaults(func=cmd_sweep)
+
+    send = commands.add_parser('send', help="Email one PDF report to each student with an address.")
+    add_inputs(send)
+    add_report_options(send)
+    send.add_argument('--smtp-host', help="Override EMAIL_SETTINGS['SMTP_HOST'].")
+    send.add_argument('--smtp-port', type=int, default=587)
+    send.add_argument('--no-starttls', action='store_true', help="Talk plain SMTP, e.g. to a local test server.")
+    send.add_argument('--out', help="Optional per-recipient results file (.csv/.parquet).")
+    send.set_defaults(func=cmd_send)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format="%(levelname)s %(message)s")
+    run = None
+    try:
+        with start_run(args.command, trace_memory=args.trace_memory or None, export=False) as run:
+            return args.func(args) or 0
+    except PipelineError as e:
+        logger.error("%s", e)
+        return 1
+    finally:
+        if run is not None:
+            for row in run.rows():
+                logger.debug("%-24s %4d calls %9d rows %9.3fs", row['stage'], row['calls'], row['rows'], row['seconds'])
+            export_run(run, args.metrics_jsonl, args.metrics_prom)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,4 +5,130 @@ THRESHOLDS = {
     'ATTENDANCE_CRITICAL': 65, 'ATTENDANCE_POOR': 75,
     'SCORE_DROP_SIGNIFICANT': 25, 'SCORE_DROP_MODERATE': 15,
     'PREVIOUS_SCORE_HIGH': 85, 'STUDY_HOURS_HIGH': 4, 'STUDY_HOURS_LOW': 1,
-}
\ No newline at end of file
+}
+
+# Expert-system rules, checked in order: the first rule whose conditions all hold sets the
+# student's status, reason and suggestion. A condition is [feature, operator, value], where
+# value is a THRESHOLDS key or a number and feature is an input column or a derived feature.
+EXPERT_INPUT_DEFAULTS = {'Average Study Hour': 2, 'fees': 1}  # used when the column is absent
+EXPERT_DERIVED_FEATURES = {
+    'score_drop': ['previous_test_score', '-', 'current_test_score'],
+    'score_improvement': ['current_test_score', '-', 'previous_test_score'],
+    'warning_count': {'count': [
+        ['current_test_score', '<=', 'MARKS_BORDERLINE'], ['attendance', '<=', 'ATTENDANCE_POOR'],
+        ['Average Study Hour', '<=', 'STUDY_HOURS_LOW'], ['fees', '!=', 1],
+    ]},
+}
+EXPERT_RULES = [
+    {'name': 'disengaged', 'when': [['current_test_score', '<', 'MARKS_FAILING'], ['attendance', '<', 'ATTENDANCE_CRITICAL']],
+     'status': 'Dropout', 'reason': 'Disengaged Student', 'suggestion': 'Suggestion: Immediate, direct intervention required.'},
+    {'name': 'high_achiever_crisis', 'when': [['previous_test_score', '>', 'PREVIOUS_SCORE_HIGH'], ['score_drop', '>', 'SCORE_DROP_SIGNIFICANT'], ['attendance', '<', 'ATTENDANCE_POOR']],
+     'status': 'Dropout', 'reason': 'High-Achiever in Crisis', 'suggestion': 'Suggestion: Urgent, sensitive mentoring needed.'},
+    {'name': 'silent_struggler', 'when': [['current_test_score', '<', 'MARKS_FAILING'], ['attendance', '>', 'ATTENDANCE_POOR'], ['Average Study Hour', '>=', 'STUDY_HOURS_HIGH']],
+     'status': 'Dropout', 'reason': 'Silent Struggler', 'suggestion': 'Suggestion: Provide academic support.'},
+    {'name': 'coasting', 'when': [['warning_count', '>=', 2]],
+     'status': 'Medium', 'reason': 'Coasting (Multiple warnings)', 'suggestion': 'Suggestion: Schedule a check-in.'},
+    {'name': 'declining', 'when': [['score_drop', '>', 'SCORE_DROP_MODERATE'], ['attendance', '<', 'ATTENDANCE_POOR']],
+     'status': 'Medium', 'reason': 'Declining Performer', 'suggestion': 'Suggestion: Proactive counseling to reverse the trend.'},
+    {'name': 'fee_risk', 'when': [['fees', '!=', 1]],
+     'status': 'Medium', 'reason': 'Administrative Risk (Fees)', 'suggestion': 'Suggestion: Alert student and guardian about fee status.'},
+    {'name': 'positive_momentum', 'when': [['score_improvement', '>', 10], ['attendance', '>', 'ATTENDANCE_POOR']],
+     'status': 'Not Dropout', 'reason': 'Positive Momentum', 'suggestion': 'Suggestion: Acknowledge and encourage progress.'},
+    {'name': 'stable_performer', 'when': [['current_test_score', '>', 'MARKS_GOOD'], ['attendance', '>', 'ATTENDANCE_POOR']],
+     'status': 'Not Dropout', 'reason': 'Stable Performer', 'suggestion': 'Suggestion: Continue standard monitoring.'},
+]
+EXPERT_DEFAULT_OUTCOME = {'status': 'Not Dropout', 'reason': 'Low Risk Profile', 'suggestion': 'Suggestion: Continue standard monitoring.'}
+
+# Outgoing mail. Rates are messages per second (0 disables the limit).
+EMAIL_SETTINGS = {
+    'SMTP_HOST': 'smtp.gmail.com', 'SMTP_PORT': 587, 'USE_STARTTLS': True, 'TIMEOUT': 30,
+    'POOL_SIZE': 4, 'MAX_MESSAGES_PER_CONNECTION': 100,
+    'PER_CONNECTION_RATE': 1.0, 'GLOBAL_RATE': 3.0, 'MAX_RETRIES': 2,
+}
+
+# PDF rendering. CHART_BACKEND is 'matplotlib' (embedded PNG) or 'vector' (drawn with FPDF primitives).
+# MAX_WORKERS=None uses every core; a batch that fits in one chunk renders in-process.
+# Cohort exports build one merged PDF with MERGED_CHART_BACKEND to avoid embedding an image per student;
+# in the dashboard they are spooled in memory up to EXPORT_SPOOL_BYTES, then to a temporary file.
+REPORTING = {
+    'CHART_BACKEND': 'matplotlib', 'MERGED_CHART_BACKEND': 'vector',
+    'MAX_WORKERS': None, 'CHUNK_SIZE': 25, 'MP_START_METHOD': 'spawn',
+    'EXPORT_SPOOL_BYTES': 32 * 1024 ** 2,
+}
+
+# Peer-group statistics shown in reports, computed once per scoring run.
+PEER_STATS = {
+    'GROUP_COLUMNS': ['ai_risk_level', 'expert_status'],
+    'METRICS': ['attendance', 'current_test_score', 'current_assignment_score', 'previous_test_score', 'previous_assignment_score'],
+    'PERCENTILES': [0.25, 0.5, 0.75],
+}
+
+# Typed ingestion. Integer columns fall back to float32 when a file holds decimals or blanks.
+INPUT_SCHEMA = {
+    'gender': 'category', 'attendance': 'int16', 'fees': 'int8',
+    'current_test_score': 'float32', 'current_assignment_score': 'float32',
+    'previous_test_score': 'float32', 'previous_assignment_score': 'float32',
+    'Average Study Hour': 'float32',
+}
+# Columns get_ml_predictions and generate_dropout_report cannot run without.
+REQUIRED_COLUMNS = [
+    'gender', 'attendance', 'fees', 'current_test_score', 'current_assignment_score',
+    'previous_test_score', 'previous_assignment_score',
+]
+# Uploads are parsed concurrently on MAX_WORKERS (None: one per CPU) threads, or processes with POOL 'process',
+# which also speeds up openpyxl-parsed workbooks. EXCEL_ENGINE 'auto' uses calamine when python-calamine is
+# installed. Parsed files are cached by content hash up to PARSE_CACHE_BYTES; the hashes of up to
+# PARSE_CACHE_UPLOADS uploads are remembered so files still in the uploader are not re-hashed.
+INGESTION = {'CSV_CHUNK_SIZE': 100_000, 'MAX_WORKERS': None, 'POOL': 'thread', 'MP_START_METHOD': 'spawn',
+             'EXCEL_ENGINE': 'auto', 'PARSE_CACHE_BYTES': 512 * 1024 ** 2, 'PARSE_CACHE_UPLOADS': 1024}
+
+# AI risk bands. Cut-points are fitted by an explicit calibration ('cli.py calibrate' or the dashboard's
+# Calibrate button; 'jenks': exact 1-D optimal split, or 'quantile') and stored with the model in the
+# registry; batches are then assigned by lookup against them. Calibration needs MIN_CALIBRATION_ROWS rows
+# and N_BANDS distinct probabilities. Uncalibrated models are banded per batch, with a warning.
+RISK_BANDS = {'METHOD': 'jenks', 'N_BANDS': 3, 'QUANTILES': [1/3, 2/3], 'MAX_DISTINCT_VALUES': 20000,
+              'MIN_CALIBRATION_ROWS': 100}
+
+# Model inference. BACKEND 'auto' scores linear models with NumPy and anything else through
+# sklearn's predict_proba; 'numpy' and 'sklearn' force one path.
+INFERENCE = {'BACKEND': 'auto', 'CHUNK_SIZE': 65536, 'DTYPE': 'float64'}
+
+# Accepted models are stored under STORE_DIR by content hash and memory-mapped on later loads.
+MODEL_REGISTRY = {'STORE_DIR': 'model_store', 'MAX_CACHE_BYTES': 256 * 1024 ** 2, 'WARM_LOAD': True}
+
+# Per-student results reused across "Predict Risk" runs when a row's inputs are unchanged.
+SCORING_CACHE = {'MAX_ENTRIES': 1_000_000}
+
+# Student list (tab 2): only the visible page is formatted and sent to the browser; exports are
+# encoded EXPORT_CHUNK_ROWS rows at a time.
+TABLE_VIEW = {'PAGE_SIZES': [25, 50, 100, 250], 'DEFAULT_PAGE_SIZE': 50, 'EXPORT_CHUNK_ROWS': 100_000}
+
+# Sidebar filters: a row bitmap per value of these columns; filtered views are memoized per filter state.
+COHORT_INDEX = {'COLUMNS': ['ai_risk_level', 'expert_status', 'fees'], 'MAX_CACHED_VIEWS': 32}
+
+# Dashboard charts. Above SCATTER_MAX_POINTS filtered students the attendance scatter is drawn
+# as a binned density per risk level ('density') or a stratified sample of at most SCATTER_MAX_POINTS
+# ('sample') that favours SAMPLE_KEEP_LEVELS, giving them up to SAMPLE_KEEP_MAX_SHARE of the points.
+CHARTS = {'SCATTER_MAX_POINTS': 5000, 'AGGREGATE_MODE': 'density', 'DENSITY_BINS': 40,
+          'MAX_MARKER_SIZE': 28, 'SAMPLE_KEEP_LEVELS': ['High'], 'SAMPLE_KEEP_MAX_SHARE': 0.5, 'SAMPLE_SEED': 0}
+
+# Persistent email outbox (SQLite). Each (student, report type, term) is delivered at most once;
+# TERM None means the calendar half-year, e.g. '2026-H2'. Transient failures retry with backoff.
+OUTBOX = {'DB_PATH': 'outbox.sqlite3', 'TERM': None, 'MAX_ATTEMPTS': 5, 'RETRY_BASE_SECONDS': 5,
+          'RETRY_MAX_SECONDS': 600, 'STALE_SENDING_SECONDS': 900, 'KEEP_SENT_PDFS': False, 'POLL_SECONDS': 2}
+
+# Per-stage run timings (utils/instrumentation.py). TRACE_MEMORY adds tracemalloc peaks at a noticeable
+# cost; JSONL_PATH appends every run, PROMETHEUS_PATH is rewritten with the latest run.
+INSTRUMENTATION = {'ENABLED': True, 'TRACE_MEMORY': False, 'JSONL_PATH': None, 'PROMETHEUS_PATH': None}
+
+# Scored-run history (utils/history.py): every run is appended under ROOT_DIR as Parquet, hive-partitioned
+# by term/class/run. CLASS_COLUMN is taken from the upload's file name when the data has no such column.
+HISTORY = {'ROOT_DIR': 'history_store', 'AUTO_SAVE': True, 'CLASS_COLUMN': 'class_name',
+           'COLUMNS': ['dropout_probability', 'ai_risk_level', 'expert_status', 'expert_reason',
+                       'attendance', 'current_test_score', 'current_assignment_score', 'fees'],
+           'ROW_GROUP_SIZE': 64 * 1024}
+
+# Expert-system what-if sweeps (RuleSet.sweep). DEFAULT_SWEEP gives (start, stop, step) for the dashboard
+# panel; CHUNK_CELLS bounds the signatures x grid points evaluated at once.
+SENSITIVITY = {'DEFAULT_SWEEP': {'MARKS_FAILING': (30, 50, 1), 'ATTENDANCE_POOR': (65, 85, 1)},
+               'MAX_GRID_POINTS': 20_000, 'CHUNK_CELLS': 4_000_000}
@@ -1,15 +1,27 @@
 # main_app.py
 
+import tempfile
 import streamlit as st
 import pandas as pd
 import plotly.express as px
+from config import TABLE_VIEW, CHARTS, OUTBOX, HISTORY, THRESHOLDS, SENSITIVITY, REPORTING
 
 # Import functions from your new utility modules
-from utils.data_processing import load_and_merge_files, load_model
-from utils.predictions import get_ml_predictions, assign_risk_levels
-from utils.expert_system import generate_dropout_report
-from utils.reporting import generate_ai_pdf, generate_rule_based_pdf
-from utils.email_sender import send_email_with_attachment
+from utils.data_processing import load_and_merge_files, load_model_with_info, HAS_PYARROW
+from utils.model_registry import get_model_registry, check_compatibility
+from utils.pipeline import score_cohort
+from utils.predictions import assign_risk_levels
+from utils.scoring_cache import get_scoring_cache
+from utils.reporting import generate_ai_pdf, generate_rule_based_pdf, generate_reports_parallel, write_reports_zip, write_merged_pdf, REPORT_FILE_PREFIXES
+from utils.peer_stats import compute_peer_stats, get_peer_metrics
+from utils.cohort_index import CohortIndex
+from utils.instrumentation import start_run
+from utils.charts import attendance_scatter
+from utils.table_view import table_page, export_bytes, DISPLAY_NAMES
+from utils.email_sender import send_email_with_attachment, get_sender_credentials, EmailJob
+from utils.outbox import get_outbox, current_term, student_key
+from utils.history import get_history_store, LEVEL_ORDER, transition_counts
+from utils.expert_system import sweep_thresholds
 
 # --- PAGE CONFIGURATION ---
 st.set_page_config(
@@ -28,6 +40,42 @@ if 'view_mode' not in st.session_state:
     st.session_state.view_mode = 'ai'
 if 'merged_data' not in st.session_state:
     st.session_state.merged_data = None
+if 'peer_stats' not in st.session_state:
+    st.session_state.peer_stats = None
+if 'cohort_index' not in st.session_state:
+    st.session_state.cohort_index = None
+
+# Resume delivering anything a previous run left in the email outbox
+sender_email, sender_password = get_sender_credentials()
+outbox = get_outbox()
+if sender_email is not None and outbox.has_pending():
+    outbox.start_worker(sender_email, sender_password)
+
+def render_delivery_progress(counts, failed, term):
+    if not counts['total']:
+        return
+    pending = counts['queued'] + counts['sending']
+    st.progress((counts['sent'] + counts['failed']) / counts['total'],
+                text=f"Term {term}: {counts['sent']} of {counts['total']} reports delivered, {pending} pending, {counts['failed']} failed")
+    if failed:
+        with st.expander(f"Could not send reports to {len(failed)} students"):
+            st.dataframe(pd.DataFrame(failed, columns=['Student', 'Email', 'Error']), hide_index=True)
+
+@st.fragment(run_every=OUTBOX['POLL_SECONDS'])
+def poll_delivery_progress(report_type, term):
+    """Polls the outbox; reruns only this fragment, so the rest of the page stays responsive."""
+    counts, failed = get_outbox().progress(report_type, term)
+    render_delivery_progress(counts, failed, term)
+    if not counts['queued'] + counts['sending']:
+        st.rerun()  # everything delivered or given up: one full rerun swaps in the static summary
+
+def show_delivery_progress(report_type, term):
+    """Delivery progress for one report type and term, polled only while reports are queued, sending or retrying."""
+    counts, failed = get_outbox().progress(report_type, term)
+    if counts['queued'] + counts['sending']:
+        poll_delivery_progress(report_type, term)
+    else:
+        render_delivery_progress(counts, failed, term)
 
 # --- SIDEBAR FOR FILE UPLOADS AND CONTROLS ---
 with st.sidebar:
@@ -43,20 +91,75 @@ with st.sidebar:
     uploaded_model = st.file_uploader("2. Upload AI Model (.joblib)", type=["joblib", "pkl"])
 
     if st.button("Predict Risk", type="primary", use_container_width=True, disabled=not (uploaded_files and uploaded_model)):
-        # NEW: Load and merge data first
-        data = load_and_merge_files(uploaded_files)
-        st.session_state.merged_data = data # Store merged data for display
-        
-        model = load_model(uploaded_model)
+        with start_run('predict_risk') as run:
+            # NEW: Load and merge data first
+            data = load_and_merge_files(uploaded_files, use_schema=True, source_column=HISTORY['CLASS_COLUMN'])
+            st.session_state.merged_data = data # Store merged data for display
         
-        if model and data is not None:
-            with st.spinner('Running predictions...'):
-                df_ml = get_ml_predictions(model, data)
-                df_ml['ai_risk_level'] = assign_risk_levels(df_ml['dropout_probability'])
-                df_expert = generate_dropout_report(data)
-                st.session_state.predictions_df = pd.concat([df_ml, df_expert], axis=1)
+            model, model_info = load_model_with_info(uploaded_model)
+            problems = check_compatibility(model_info, data.columns) if model is not None and data is not None else []
+            for problem in problems:
+                st.error(problem)
+
+            if model and data is not None and not problems:
+                with st.spinner('Running predictions...'):
+                    scoring_cache = get_scoring_cache()
+                    # Renamed once here for easier attribute access, not on every rerun
+                    st.session_state.predictions_df = score_cohort(model, data, scoring_cache, model_info.sha256).rename(columns={'Student Name': 'Student_Name'})
+                    st.session_state.model_sha = model_info.sha256
+                    st.session_state.cohort_index = CohortIndex(st.session_state.predictions_df)
+                    st.session_state.scoring_stats = scoring_cache.stats()
+                    st.session_state.peer_stats = compute_peer_stats(st.session_state.predictions_df)
+                    if HISTORY['AUTO_SAVE'] and HAS_PYARROW:
+                        get_history_store().append(st.session_state.predictions_df, current_term(), model_sha=model_info.sha256)
+        st.session_state.last_run = run
     st.markdown("---")
+
+    if st.session_state.get('scoring_stats'):
+        stats = st.session_state.scoring_stats
+        st.caption(f"Last run: {stats['last_hits']} students reused from cache, {stats['last_misses']} scored "
+                   f"({stats['hits']} hits / {stats['misses']} misses in total).")
+
+    scored_model = get_model_registry().get(st.session_state.model_sha) if st.session_state.get('model_sha') and st.session_state.predictions_df is not None else None
+    if scored_model is not None:
+        model, model_info = scored_model
+        calibrate_label = "Recalibrate Risk Bands on This Cohort" if model_info.risk_band_cuts else "Calibrate Risk Bands on This Cohort"
+        if st.button(calibrate_label, use_container_width=True,
+                     help="Fixes the model's High/Medium/Low cut-points on this cohort and stores them with the model; later batches are banded against them."):
+            scored = st.session_state.predictions_df
+            try:
+                cuts = get_model_registry().calibrate(model, model_info, scored['dropout_probability'])
+            except ValueError as e:
+                st.error(str(e))
+            else:
+                scored = scored.assign(ai_risk_level=assign_risk_levels(scored['dropout_probability'], cuts))
+                st.session_state.predictions_df = scored
+                st.session_state.cohort_index = CohortIndex(scored)
+                st.session_state.peer_stats = compute_peer_stats(scored)
+                st.success("Risk bands calibrated: " + ", ".join(f"{c:.1%}" for c in cuts))
+
+    model_infos = get_model_registry().infos()
+    if model_infos:
+        with st.expander("Loaded Models"):
+            st.dataframe(pd.DataFrame([{'SHA-256': i.sha256[:12], 'Type': i.model_type.rsplit('.', 1)[-1], 'Features': i.n_features,
+                                        'NumPy Fast Path': i.linear_fast_path, 'Risk Bands': i.risk_band_cuts} for i in model_infos]),
+                         hide_index=True)
     
+    last_run = st.session_state.get('last_run')
+    if last_run is not None and last_run.stages:
+        with st.expander("⏱️ Last Run Timings"):
+            timings = pd.DataFrame(last_run.rows())
+            timings['share'] = timings['seconds'] / last_run.seconds
+            st.dataframe(timings, hide_index=True, column_config={
+                'seconds': st.column_config.NumberColumn("Seconds", format="%.3f"),
+                'share': st.column_config.ProgressColumn("Share of Run", min_value=0.0, max_value=1.0, format="percent"),
+                'peak_bytes': st.column_config.NumberColumn("Peak Memory (bytes)", format="compact"),
+            })
+            st.caption(f"{last_run.name}: {last_run.seconds:.2f}s in total. Nested stages (e.g. parse_file inside load_and_merge_files) overlap.")
+            d1, d2 = st.columns(2)
+            d1.download_button("JSON lines", data=last_run.to_jsonl(), file_name=f"run_{last_run.run_id}.jsonl", mime="application/x-ndjson", on_click="ignore")
+            d2.download_button("Prometheus", data=last_run.to_prometheus(), file_name="student_dashboard.prom", mime="text/plain", on_click="ignore")
+
     # NEW: Expander to show the merged data
     if st.session_state.merged_data is not None:
         with st.expander("View Merged Data"):
@@ -65,10 +168,14 @@ with st.sidebar:
 # --- MAIN PANEL DISPLAY ---
 if st.session_state.predictions_df is not None:
     df = st.session_state.predictions_df
-    # RENAME 'Student Name' column for easier attribute access
-    if 'Student Name' in df.columns:
-        df = df.rename(columns={'Student Name': 'Student_Name'})
-        st.session_state.predictions_df = df # Update session state
+    if st.session_state.cohort_index is None or st.session_state.cohort_index.df is not df:
+        if 'Student Name' in df.columns:
+            df = st.session_state.predictions_df = df.rename(columns={'Student Name': 'Student_Name'})
+        st.session_state.cohort_index = CohortIndex(df)
+    cohort = st.session_state.cohort_index
+    if st.session_state.peer_stats is None:
+        st.session_state.peer_stats = compute_peer_stats(df)
+    peer_stats = st.session_state.peer_stats
 
     is_ai_view = st.session_state.view_mode == 'ai'
     c1, c2 = st.columns(2)
@@ -79,32 +186,28 @@ if st.session_state.predictions_df is not None:
 
     # Sidebar filters (appear after prediction)
     st.sidebar.header("📊 Filter Students")
-    if is_ai_view:
-        options = sorted(df['ai_risk_level'].unique())
-        selection = st.sidebar.multiselect("Filter by AI Risk Level", options=options, default=options)
-        filtered_df = df[df['ai_risk_level'].isin(selection)]
-    else:
-        options = sorted(df['expert_status'].unique())
-        selection = st.sidebar.multiselect("Filter by Expert Status", options=options, default=options)
-        filtered_df = df[df['expert_status'].isin(selection)]
-    
+    status_column = 'ai_risk_level' if is_ai_view else 'expert_status'
+    options = cohort.options(status_column)
+    label = "Filter by AI Risk Level" if is_ai_view else "Filter by Expert Status"
+    selection = st.sidebar.multiselect(label, options=options, default=options)
+
     fee_filter = st.sidebar.selectbox("Filter by Fee Status", options=['All', 'Paid', 'Unpaid'])
-    if fee_filter != 'All':
-        fee_val = 1 if fee_filter == 'Paid' else 0
-        filtered_df = filtered_df[filtered_df['fees'] == fee_val]
+    filters = {status_column: selection, 'fees': None if fee_filter == 'All' else [1 if fee_filter == 'Paid' else 0]}
+    _, filtered_df = cohort.view(filters)
+    n_filtered = len(filtered_df)
     
     # --- TABS FOR DISPLAYING RESULTS ---
-    tab1, tab2, tab3 = st.tabs(["📊 Dashboard Overview", "📋 Detailed Student List", "📄 Individual Reporting"])
+    tab1, tab2, tab3, tab4 = st.tabs(["📊 Dashboard Overview", "📋 Detailed Student List", "📄 Individual Reporting", "📈 History"])
     
     # --- TAB 1: DASHBOARD OVERVIEW ---
     with tab1:
         if is_ai_view:
             st.subheader("AI Model: High-Level Metrics")
             kpi1, kpi2, kpi3 = st.columns(3)
-            kpi1.metric(label="**Filtered Students**", value=len(filtered_df))
-            kpi2.metric(label="**High-Risk Students**", value=filtered_df[filtered_df['ai_risk_level'] == 'High'].shape[0])
-            avg_prob = filtered_df['dropout_probability'].mean() if not filtered_df.empty else 0
-            kpi3.metric(label="**Avg. Dropout Probability**", value=f"{avg_prob:.2%}")
+            risk_counts = cohort.value_counts('ai_risk_level', filters)
+            kpi1.metric(label="**Filtered Students**", value=n_filtered)
+            kpi2.metric(label="**High-Risk Students**", value=int(risk_counts.get('High', 0)))
+            kpi3.metric(label="**Avg. Dropout Probability**", value=f"{cohort.mean('dropout_probability', filters):.2%}")
             st.markdown("---")
             st.subheader("AI Model: Visualizations")
             col1, col2 = st.columns(2)
@@ -112,27 +215,37 @@ if st.session_state.predictions_df is not None:
             with col1:
                 st.markdown("##### Risk Level Distribution")
                 if not filtered_df.empty:
-                    risk_counts = filtered_df['ai_risk_level'].value_counts()
-                    fig_pie = px.pie(values=risk_counts.values, names=risk_counts.index, hole=0.4, 
-                                     color=risk_counts.index, color_discrete_map=color_map)
+                    fig_pie = cohort.memoize('fig_pie', filters, lambda: px.pie(
+                        values=risk_counts.values, names=risk_counts.index, hole=0.4,
+                        color=risk_counts.index, color_discrete_map=color_map))
                     st.plotly_chart(fig_pie, use_container_width=True)
                 else:
                     st.info("No data to display for the current filter.")
             with col2:
                 st.markdown("##### Attendance vs. Dropout Probability")
                 if not filtered_df.empty:
-                    fig_scatter = px.scatter(filtered_df, x='attendance', y='dropout_probability', 
-                                             color='ai_risk_level', color_discrete_map=color_map,
-                                             labels={'attendance': 'Attendance (%)', 'dropout_probability': 'Dropout Probability'})
+                    scatter_mode = CHARTS['AGGREGATE_MODE']
+                    if n_filtered > CHARTS['SCATTER_MAX_POINTS']:
+                        scatter_mode = st.radio("Large cohort view", ['density', 'sample'], horizontal=True,
+                                                index=['density', 'sample'].index(CHARTS['AGGREGATE_MODE']),
+                                                format_func={'density': 'Binned density', 'sample': 'Stratified sample'}.get)
+                    fig_scatter, drawn_as, payload = cohort.memoize(('fig_scatter', scatter_mode), filters,
+                                                                    lambda: attendance_scatter(filtered_df, color_map, mode=scatter_mode))
                     st.plotly_chart(fig_scatter, use_container_width=True)
+                    if drawn_as != 'points':
+                        detail = "binned by risk level" if drawn_as == 'density' else "shown as a stratified sample with every High-risk student kept"
+                        st.caption(f"{n_filtered:,} students {detail}; chart payload {payload / 1024:,.0f} KB.")
+                    else:
+                        st.caption(f"Chart payload {payload / 1024:,.0f} KB.")
                 else:
                     st.info("No data to display for the current filter.")
         else: # Rule-Based View
             st.subheader("Expert System: High-Level Metrics")
             kpi1, kpi2, kpi3 = st.columns(3)
-            kpi1.metric(label="**Filtered Students**", value=len(filtered_df))
-            kpi2.metric(label="**'Dropout' Status**", value=filtered_df[filtered_df['expert_status'] == 'Dropout'].shape[0])
-            kpi3.metric(label="**'Medium' Status**", value=filtered_df[filtered_df['expert_status'] == 'Medium'].shape[0])
+            expert_counts = cohort.value_counts('expert_status', filters)
+            kpi1.metric(label="**Filtered Students**", value=n_filtered)
+            kpi2.metric(label="**'Dropout' Status**", value=int(expert_counts.get('Dropout', 0)))
+            kpi3.metric(label="**'Medium' Status**", value=int(expert_counts.get('Medium', 0)))
             st.markdown("---")
             st.subheader("Expert System: Visualizations")
             col1, col2 = st.columns(2)
@@ -140,29 +253,77 @@ if st.session_state.predictions_df is not None:
             with col1:
                 st.markdown("##### Status Distribution")
                 if not filtered_df.empty:
-                    expert_counts = filtered_df['expert_status'].value_counts()
-                    fig_bar = px.bar(expert_counts, x=expert_counts.index, y=expert_counts.values,
-                                     color=expert_counts.index, color_discrete_map=expert_color_map,
-                                     labels={'x':'Status', 'y':'Number of Students'})
+                    fig_bar = cohort.memoize('fig_bar', filters, lambda: px.bar(
+                        expert_counts, x=expert_counts.index, y=expert_counts.values,
+                        color=expert_counts.index, color_discrete_map=expert_color_map,
+                        labels={'x':'Status', 'y':'Number of Students'}))
                     st.plotly_chart(fig_bar, use_container_width=True)
                 else:
                     st.info("No data to display for the current filter.")
             with col2:
                 st.markdown("##### Breakdown of Reasons for 'Dropout' & 'Medium'")
                 if not filtered_df.empty:
-                    reason_df = filtered_df[filtered_df['expert_status'].isin(['Dropout', 'Medium'])]
-                    if not reason_df.empty:
-                        reason_counts = reason_df['expert_reason'].value_counts()
-                        fig_hbar = px.bar(reason_counts, y=reason_counts.index, x=reason_counts.values, 
-                                          orientation='h', labels={'y':'Reason', 'x':'Number of Students'},
-                                          title="Reasons for At-Risk Status")
-                        fig_hbar.update_layout(yaxis={'categoryorder':'total ascending'})
+                    at_risk = {**filters, 'expert_status': [s for s in selection if s in ('Dropout', 'Medium')]}
+                    reason_counts = cohort.value_counts('expert_reason', at_risk)
+                    if not reason_counts.empty:
+                        def reason_chart():
+                            fig = px.bar(reason_counts, y=reason_counts.index, x=reason_counts.values,
+                                         orientation='h', labels={'y':'Reason', 'x':'Number of Students'},
+                                         title="Reasons for At-Risk Status")
+                            return fig.update_layout(yaxis={'categoryorder':'total ascending'})
+                        fig_hbar = cohort.memoize('fig_hbar', at_risk, reason_chart)
                         st.plotly_chart(fig_hbar, use_container_width=True)
                     else:
                         st.info("No 'Dropout' or 'Medium' status students in the current filter.")
                 else:
                     st.info("No data to display for the current filter.")
 
+            st.markdown("---")
+            with st.expander("🎚️ Threshold What-If"):
+                st.caption("Counts the filtered students in each expert status for every combination of the threshold values below.")
+                swept = st.multiselect("Thresholds to vary", options=list(THRESHOLDS), default=list(SENSITIVITY['DEFAULT_SWEEP']), max_selections=3)
+                grid = {}
+                for name in swept:
+                    current = THRESHOLDS[name]
+                    start, stop, step = SENSITIVITY['DEFAULT_SWEEP'].get(name, (max(current - 5, 0), current + 5, 1))
+                    w1, w2, w3 = st.columns(3)
+                    start = w1.number_input(f"{name} from", value=start, step=1, key=f"sweep_{name}_start")
+                    stop = w2.number_input(f"{name} to", value=stop, step=1, key=f"sweep_{name}_stop")
+                    step = w3.number_input(f"{name} step", min_value=1, value=step, step=1, key=f"sweep_{name}_step")
+                    grid[name] = list(range(int(start), int(stop) + 1, int(step)))
+                n_points = 1
+                for values in grid.values():
+                    n_points *= len(values)
+                if not grid or not n_points or filtered_df.empty:
+                    st.info("Pick at least one threshold with a non-empty range.")
+                elif n_points > SENSITIVITY['MAX_GRID_POINTS']:
+                    st.warning(f"{n_points:,} combinations; narrow the ranges to at most {SENSITIVITY['MAX_GRID_POINTS']:,}.")
+                else:
+                    grid_key = tuple((name, tuple(values)) for name, values in grid.items())
+                    sweep = cohort.memoize(('threshold_sweep', grid_key), filters, lambda: sweep_thresholds(filtered_df, grid))
+                    shown_status = st.selectbox("Status to chart", options=list(expert_color_map), index=0)
+                    fixed = {name: st.select_slider(f"Hold {name} at", options=grid[name], key=f"sweep_{name}_hold",
+                                                    value=THRESHOLDS[name] if THRESHOLDS[name] in grid[name] else grid[name][0])
+                             for name in swept[2:]}
+                    view = sweep
+                    for name, value in fixed.items():
+                        view = view[view[name] == value]
+                    if len(swept) == 1:
+                        fig_sweep = px.line(view, x=swept[0], y=list(expert_color_map), markers=True,
+                                            color_discrete_map=expert_color_map, labels={'value': 'Number of Students', 'variable': 'Status'})
+                    else:
+                        matrix = view.pivot(index=swept[0], columns=swept[1], values=shown_status)
+                        fig_sweep = px.imshow(matrix, text_auto=True, aspect='auto', origin='lower', color_continuous_scale='Reds',
+                                              labels={'color': f"'{shown_status}' Students"})
+                    st.plotly_chart(fig_sweep, use_container_width=True)
+                    current_row = sweep
+                    for name in swept:
+                        current_row = current_row[current_row[name] == THRESHOLDS[name]]
+                    if not current_row.empty:
+                        st.caption(f"Current thresholds ({', '.join(f'{n}={THRESHOLDS[n]}' for n in swept)}): "
+                                   + ", ".join(f"{int(current_row[s].iloc[0]):,} {s}" for s in expert_color_map if s in current_row))
+                    st.dataframe(sweep, hide_index=True, use_container_width=True)
+
     # --- TAB 2: DETAILED STUDENT LIST ---
     with tab2:
         with st.expander("View and Filter Student List 👁️", expanded=True):
@@ -186,21 +347,26 @@ if st.session_state.predictions_df is not None:
                 if not selected_columns:
                     st.warning("Please select at least one column to display.")
                 else:
-                    display_df = filtered_df[selected_columns].copy()
-                    if 'dropout_probability' in display_df.columns:
-                        display_df['dropout_probability'] = display_df['dropout_probability'].map('{:.2%}'.format)
-                    if 'fees' in display_df.columns:
-                        display_df['fees'] = display_df['fees'].apply(lambda x: 'Paid' if x == 1 else 'Unpaid')
-                        
-                    rename_mapping = {
-                        'Student_Name': 'Student Name', 'ai_risk_level': 'AI Risk', 'dropout_probability': 'AI Probability',
-                        'expert_status': 'Expert Status', 'expert_reason': 'Expert Reason',
-                        'current_test_score': 'Test Score', 'attendance': 'Attendance (%)', 'fees': 'Fee Status',
-                        'gender': 'Gender', 'previous_test_score': 'Previous Score'
-                    }
-                    columns_to_rename = {k: v for k, v in rename_mapping.items() if k in display_df.columns}
-                    display_df = display_df.rename(columns=columns_to_rename)
-                    st.table(display_df)
+                    t1, t2, t3 = st.columns([2, 1, 1])
+                    sort_by = t1.selectbox("Sort by", options=[None] + selected_columns,
+                                           format_func=lambda c: "Original order" if c is None else DISPLAY_NAMES.get(c, c))
+                    descending = t2.toggle("Descending", value=False, disabled=sort_by is None)
+                    page_size = t3.selectbox("Rows per page", options=TABLE_VIEW['PAGE_SIZES'],
+                                             index=TABLE_VIEW['PAGE_SIZES'].index(TABLE_VIEW['DEFAULT_PAGE_SIZE']))
+                    n_pages = max(1, -(-len(filtered_df) // page_size))
+                    page = st.number_input(f"Page (of {n_pages})", min_value=1, max_value=n_pages, value=1, step=1)
+
+                    page_df, total_rows, n_pages = table_page(filtered_df, selected_columns, sort_by, not descending, page, page_size)
+                    st.dataframe(page_df, hide_index=True, use_container_width=True)
+                    first_row = (page - 1) * page_size + 1
+                    st.caption(f"Showing rows {first_row}–{first_row + len(page_df) - 1} of {total_rows}.")
+
+                st.markdown("##### Export Filtered Students")
+                e1, e2 = st.columns(2)
+                e1.download_button("⬇️ Download CSV", data=lambda: export_bytes(filtered_df, 'csv'), file_name="students.csv",
+                                   mime="text/csv", on_click="ignore", use_container_width=True)
+                e2.download_button("⬇️ Download Parquet", data=lambda: export_bytes(filtered_df, 'parquet'), file_name="students.parquet",
+                                   mime="application/octet-stream", on_click="ignore", use_container_width=True, disabled=not HAS_PYARROW)
             else:
                 st.info("No students match the current filter criteria.")
 
@@ -224,12 +390,12 @@ if st.session_state.predictions_df is not None:
 
                 if report_type_single == 'AI-Based Report':
                     ai_risk_group = student_data_series['ai_risk_level']
-                    ai_peer_metrics = {'attendance': df[df['ai_risk_level'] == ai_risk_group]['attendance'].mean(), 'current_test_score': df[df['ai_risk_level'] == ai_risk_group]['current_test_score'].mean()}
+                    ai_peer_metrics = get_peer_metrics(peer_stats, 'ai_risk_level', ai_risk_group)
                     pdf_data = generate_ai_pdf(pdf_student_data, ai_peer_metrics)
                     report_prefix = "AI_Based"
                 else: # Rule-Based Report
                     rule_status_group = student_data_series['expert_status']
-                    rule_peer_metrics = {'attendance': df[df['expert_status'] == rule_status_group]['attendance'].mean(), 'current_test_score': df[df['expert_status'] == rule_status_group]['current_test_score'].mean()}
+                    rule_peer_metrics = get_peer_metrics(peer_stats, 'expert_status', rule_status_group)
                     pdf_data = generate_rule_based_pdf(pdf_student_data, rule_peer_metrics)
                     report_prefix = "Rule_Based"
                 
@@ -243,12 +409,12 @@ if st.session_state.predictions_df is not None:
                     email_found = email_column_name in student_data_series.index and pd.notna(student_data_series[email_column_name])
                     
                     if st.button(f"📧 Email Report to {selected_student_name}", use_container_width=True, disabled=not email_found):
-                        if 'sender_email' in st.secrets and 'sender_password' in st.secrets:
+                        if sender_email is not None:
                             recipient_email = student_data_series[email_column_name]
                             subject = f"{report_type_single} for {selected_student_name}"
                             body = f"Hello,\n\nPlease find the attached {report_type_single.lower()} for {selected_student_name}.\n\nBest regards,"
                             if send_email_with_attachment(recipient_email, subject, body, pdf_data, selected_student_name, report_prefix):
-                                st.success(f"Report successfully sent to {recipient_email}!")
+                                st.success(f"Report to {recipient_email} queued for delivery.")
                         else:
                             st.warning("Auto-sending is not configured in your secrets.toml file.")
                     if not email_found:
@@ -258,64 +424,139 @@ if st.session_state.predictions_df is not None:
 
         st.markdown("---")
 
+        st.subheader("Download Reports for Filtered Students")
+
+        if not filtered_df.empty:
+            x1, x2 = st.columns(2)
+            report_type_export = x1.radio("Report Type to Export", ('AI-Based Report', 'Rule-Based Report'), key="export_report_type", horizontal=True)
+            export_format = x2.radio("Format", ('ZIP of PDFs', 'Single merged PDF'), key="export_format", horizontal=True)
+
+            if st.button(f"📦 Prepare Reports for {len(filtered_df)} Filtered Students", use_container_width=True):
+                report_key = 'ai' if report_type_export == 'AI-Based Report' else 'rule'
+                total = len(filtered_df)
+                progress_bar = st.progress(0, text="Rendering reports...")
+                def on_progress(n_done, student):
+                    progress_bar.progress(n_done / total, text=f"Rendered {n_done} of {total} reports")
+
+                # Reports are written to a spooled file as they finish, so only the ones in flight stay in memory.
+                export_fh = tempfile.SpooledTemporaryFile(max_size=REPORTING['EXPORT_SPOOL_BYTES'])
+                with start_run('export_reports') as run:
+                    if export_format == 'ZIP of PDFs':
+                        write_reports_zip(filtered_df, report_key, export_fh, peer_stats, on_progress)
+                        export_name, export_mime = f"{REPORT_FILE_PREFIXES[report_key]}_Reports.zip", "application/zip"
+                    else:
+                        write_merged_pdf(filtered_df, report_key, export_fh, peer_stats, on_progress)
+                        export_name, export_mime = f"{REPORT_FILE_PREFIXES[report_key]}_Reports.pdf", "application/pdf"
+                st.session_state.last_run = run
+                st.session_state.report_export = (export_name, export_mime, export_fh)
+                progress_bar.empty()
+
+            if st.session_state.get('report_export') is not None:
+                export_name, export_mime, export_fh = st.session_state.report_export
+                def read_export():
+                    export_fh.seek(0)
+                    return export_fh.read()
+                st.download_button(f"⬇️ Download {export_name}", data=read_export, file_name=export_name, mime=export_mime,
+                                   on_click="ignore", use_container_width=True)
+        else:
+            st.warning("No students available based on current filters.")
+
+        st.markdown("---")
+
         st.subheader("Send Reports to Multiple Students (Bulk)")
         
         if not filtered_df.empty:
             st.info(f"Your current filters match **{len(filtered_df)}** students.")
-            secrets_configured = 'sender_email' in st.secrets and 'sender_password' in st.secrets
+            secrets_configured = sender_email is not None
             
             report_type_bulk = st.radio("Select Report Type for Bulk Sending", ('AI-Based Report', 'Rule-Based Report'), key="bulk_report_type", horizontal=True)
+            term = st.text_input("Term", value=current_term(), help="Each student receives a report type at most once per term.")
+            report_prefix = "AI_Based" if report_type_bulk == 'AI-Based Report' else "Rule_Based"
 
             if st.button(f"📧 Send {report_type_bulk}s to {len(filtered_df)} Filtered Students", type="primary", use_container_width=True, disabled=not secrets_configured):
-                success_list = []; fail_list = []
-                email_column_name = 'student_email'
-                report_prefix = "AI_Based" if report_type_bulk == 'AI-Based Report' else "Rule_Based"
-
-                progress_bar = st.progress(0, text="Initializing bulk send...")
-                
-                for i, student_tuple in enumerate(filtered_df.itertuples(index=False)):
-                    student_data = pd.Series(student_tuple, index=filtered_df.columns)
-                    student_name = student_data['Student_Name']
-                    
-                    progress_text = f"Processing report for: {student_name}"
-                    progress_bar.progress((i + 1) / len(filtered_df), text=progress_text)
-                    
-                    if email_column_name not in student_data.index or pd.isna(student_data[email_column_name]):
+                with start_run('bulk_send') as run:
+                    email_column_name = 'student_email'
+                    has_email = filtered_df[email_column_name].notna() if email_column_name in filtered_df.columns else pd.Series(False, index=filtered_df.index)
+                    missing_email = filtered_df.loc[~has_email, 'Student_Name'].tolist()
+                    for student_name in missing_email:
                         st.toast(f"Skipping {student_name}: Email ID does not exist.", icon="⚠️")
-                        fail_list.append(f"{student_name} (Missing Email)")
-                        continue
-                    
-                    pdf_student_data = student_data.copy()
-                    pdf_student_data['Student Name'] = student_data['Student_Name']
-                    pdf_data_bulk = b""
-
-                    if report_type_bulk == 'AI-Based Report':
-                        ai_risk_group = student_data['ai_risk_level']
-                        ai_peer_metrics = {'attendance': df[df['ai_risk_level'] == ai_risk_group]['attendance'].mean(), 'current_test_score': df[df['ai_risk_level'] == ai_risk_group]['current_test_score'].mean()}
-                        pdf_data_bulk = generate_ai_pdf(pdf_student_data, ai_peer_metrics)
-                    else: # Rule-Based Report
-                        rule_status_group = student_data['expert_status']
-                        rule_peer_metrics = {'attendance': df[df['expert_status'] == rule_status_group]['attendance'].mean(), 'current_test_score': df[df['expert_status'] == rule_status_group]['current_test_score'].mean()}
-                        pdf_data_bulk = generate_rule_based_pdf(pdf_student_data, rule_peer_metrics)
-                        
-                    recipient_email = student_data[email_column_name]
-                    subject = f"Your Student Performance Report ({report_prefix.replace('_', ' ')})"
-                    body = f"Hello {student_name},\n\nPlease find your attached {report_type_bulk.lower()}.\n\nBest regards,"
-                    
-                    if send_email_with_attachment(recipient_email, subject, body, pdf_data_bulk, student_name, report_prefix):
-                        success_list.append(student_name)
-                    else:
-                        fail_list.append(f"{student_name} (Send Error)")
 
-                progress_bar.empty()
-                st.success(f"**Bulk Send Complete!** Successfully sent reports to {len(success_list)} students.")
-                if fail_list:
-                    st.warning(f"Could not send reports to {len(fail_list)} students:")
-                    st.json(fail_list)
+                    # Students already queued or sent this term are skipped before their PDFs are rendered.
+                    handled = outbox.handled_keys(report_prefix, term)
+                    to_send = filtered_df[has_email]
+                    keys = [student_key(n, e) for n, e in zip(to_send['Student_Name'], to_send[email_column_name])]
+                    to_send = to_send[[key not in handled for key in keys]]
+
+                    queued = 0
+                    progress_bar = st.progress(0, text="Generating reports...")
+                    report_key = 'ai' if report_type_bulk == 'AI-Based Report' else 'rule'
+                    for student_data, pdf_data_bulk in generate_reports_parallel(to_send, report_key, peer_stats):
+                        student_name = student_data['Student_Name']
+                        subject = f"Your Student Performance Report ({report_prefix.replace('_', ' ')})"
+                        body = f"Hello {student_name},\n\nPlease find your attached {report_type_bulk.lower()}.\n\nBest regards,"
+                        queued += outbox.enqueue(EmailJob(student_data[email_column_name], subject, body, pdf_data_bulk, student_name, report_prefix), term)
+                        if queued == 1:
+                            outbox.start_worker(sender_email, sender_password)  # start delivering while the rest render
+                        progress_bar.progress(queued / len(to_send), text=f"Queued report for: {student_name}")
+                    if queued:
+                        outbox.start_worker(sender_email, sender_password)
+
+                    progress_bar.empty()
+                    st.success(f"**{queued} reports queued.** {len(filtered_df[has_email]) - len(to_send)} students already had this report for term {term}.")
+                    if missing_email:
+                        st.warning(f"Could not send reports to {len(missing_email)} students without an email address:")
+                        st.json(missing_email)
+                st.session_state.last_run = run
+
+            show_delivery_progress(report_prefix, term)
             
             if not secrets_configured:
                 st.warning("Bulk sending is disabled. Please configure your email credentials in secrets.toml.")
         else:
             st.warning("No students to process. Adjust your filters to select a group of students.")
+    # --- TAB 4: RUN HISTORY ---
+    with tab4:
+        history_runs = get_history_store().runs() if HAS_PYARROW else None
+        if history_runs is None:
+            st.info("Run history needs pyarrow installed.")
+        elif history_runs.empty:
+            st.info("No saved runs yet. Each \"Predict Risk\" run is added to the history.")
+        else:
+            history = get_history_store()
+            level_column = 'ai_risk_level' if is_ai_view else 'expert_status'
+            run_ids = history_runs['run'].tolist()
+            run_labels = {r.run: f"{r.run_at:%Y-%m-%d %H:%M} · {r.term} · {r.students:,} students" for r in history_runs.itertuples()}
+
+            st.subheader("AI Risk Level Transitions" if is_ai_view else "Expert Status Transitions")
+            h1, h2 = st.columns(2)
+            from_run = h1.selectbox("From run", run_ids, index=max(len(run_ids) - 2, 0), format_func=run_labels.get)
+            to_run = h2.selectbox("To run", run_ids, index=len(run_ids) - 1, format_func=run_labels.get)
+            pairs = history.compare_runs(from_run, to_run, level_column)
+            matrix = transition_counts(pairs)
+            matrix.index, matrix.columns = matrix.index.astype(str), matrix.columns.astype(str)
+            fig_transitions = px.imshow(matrix, text_auto=True, color_continuous_scale='Reds',
+                                        labels={'x': 'To', 'y': 'From', 'color': 'Students'})
+            st.plotly_chart(fig_transitions, use_container_width=True)
+            st.caption(f"{len(pairs):,} students were scored in both runs.")
+
+            levels = LEVEL_ORDER[level_column]
+            m1, m2 = st.columns(2)
+            moved_from = m1.selectbox("Moved from", levels, index=0)
+            moved_to = m2.selectbox("Moved to", levels, index=len(levels) - 1)
+            movers = pairs[(pairs['from'] == moved_from) & (pairs['to'] == moved_to)]
+            st.dataframe(movers, hide_index=True, use_container_width=True)
+            st.markdown("---")
+
+            st.subheader("Student Risk Trajectory")
+            history_student = st.selectbox("Select a student:", filtered_df['Student_Name'].tolist(), key="history_student_select")
+            trajectory = history.trajectory(history_student) if history_student is not None else pd.DataFrame()
+            if trajectory.empty:
+                st.info("This student does not appear in any saved run.")
+            else:
+                fig_trajectory = px.line(trajectory, x='run_at', y='dropout_probability', markers=True,
+                                         hover_data=['term', 'class', 'ai_risk_level', 'expert_status'],
+                                         labels={'run_at': 'Run', 'dropout_probability': 'Dropout Probability'})
+                st.plotly_chart(fig_trajectory, use_container_width=True)
+                st.dataframe(trajectory, hide_index=True, use_container_width=True)
 else:
     st.info("**Welcome!** Upload your data and model in the sidebar to begin.")
\ No newline at end of file
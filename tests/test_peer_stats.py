@@ -0,0 +1,23 @@
+# tests/test_peer_stats.py
+
+import math
+import numpy as np
+import pandas as pd
+from utils.peer_stats import compute_peer_stats, get_peer_metrics
+
+def _cohort():
+    return pd.DataFrame({
+        'ai_risk_level': ['High', 'High', 'Low', np.nan],
+        'attendance': [50.0, 70.0, 90.0, 80.0],
+        'current_test_score': [40.0, 60.0, 85.0, 75.0],
+    })
+
+def test_known_group_returns_its_means():
+    peer_stats = compute_peer_stats(_cohort(), ['ai_risk_level'], ['attendance', 'current_test_score'], [])
+    assert get_peer_metrics(peer_stats, 'ai_risk_level', 'High') == {'attendance': 60.0, 'current_test_score': 50.0}
+
+def test_nan_group_gets_nan_metrics():
+    peer_stats = compute_peer_stats(_cohort(), ['ai_risk_level'], ['attendance', 'current_test_score'], [])
+    metrics = get_peer_metrics(peer_stats, 'ai_risk_level', float('nan'))
+    assert set(metrics) == {'attendance', 'current_test_score'}
+    assert all(math.isnan(value) for value in metrics.values())
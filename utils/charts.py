@@ -0,0 +1,90 @@
+# utils/charts.py
+
+import numpy as np
+import plotly.express as px
+import plotly.graph_objects as go
+from config import CHARTS
+
+SCATTER_LABELS = {'attendance': 'Attendance (%)', 'dropout_probability': 'Dropout Probability'}
+
+def payload_bytes(fig):
+    """Size of the figure JSON the browser has to download."""
+    return len(fig.to_json())
+
+def stratified_sample(df, color_column, max_points, keep_levels=None, seed=None):
+    """
+    At most `max_points` rows drawn in proportion to each `color_column` level. Rows in `keep_levels`
+    (the high-risk outliers) are all kept while they fit in SAMPLE_KEEP_MAX_SHARE of the budget (or the
+    room the other levels leave); beyond that they are sampled down too.
+    """
+    keep_levels = CHARTS['SAMPLE_KEEP_LEVELS'] if keep_levels is None else keep_levels
+    rng = np.random.default_rng(CHARTS['SAMPLE_SEED'] if seed is None else seed)
+    levels = df[color_column].astype(object).to_numpy()
+    kept = np.isin(levels, keep_levels)
+    others = np.flatnonzero(~kept)
+    kept = np.flatnonzero(kept)
+    keep_cap = max(int(max_points * CHARTS['SAMPLE_KEEP_MAX_SHARE']), max_points - len(others))
+    if len(kept) > keep_cap:
+        kept = rng.choice(kept, keep_cap, replace=False)
+    budget = max_points - len(kept)
+    chosen = [kept]
+    if budget and len(others):
+        other_levels = levels[others]
+        for level in dict.fromkeys(other_levels):
+            members = others[other_levels == level]
+            take = min(len(members), budget * len(members) // len(others))
+            chosen.append(rng.choice(members, take, replace=False))
+    return df.iloc[np.sort(np.concatenate(chosen))]
+
+def binned_scatter(df, x, y, color_column, color_map, bins=None, max_marker=None):
+    """
+    Server-side 2-D histogram per `color_column` level, drawn as one marker per non-empty bin
+    sized by its count, so the figure grows with the bin count rather than the row count.
+    """
+    bins = bins or CHARTS['DENSITY_BINS']
+    max_marker = max_marker or CHARTS['MAX_MARKER_SIZE']
+    xs = df[x].to_numpy(dtype=np.float64)
+    ys = df[y].to_numpy(dtype=np.float64)
+    finite = np.isfinite(xs) & np.isfinite(ys)
+    x_edges = np.histogram_bin_edges(xs[finite], bins)
+    y_edges = np.histogram_bin_edges(ys[finite], bins)
+    x_centres = (x_edges[:-1] + x_edges[1:]) / 2
+    y_centres = (y_edges[:-1] + y_edges[1:]) / 2
+
+    levels = df[color_column].astype(object).to_numpy()
+    histograms = {}
+    for level in dict.fromkeys(levels[finite]):
+        in_level = finite & (levels == level)
+        histograms[level], _, _ = np.histogram2d(xs[in_level], ys[in_level], bins=[x_edges, y_edges])
+    largest = max((h.max() for h in histograms.values()), default=1)
+
+    fig = go.Figure()
+    for level, counts in histograms.items():
+        ix, iy = np.nonzero(counts)
+        n = counts[ix, iy]
+        fig.add_trace(go.Scatter(
+            x=x_centres[ix], y=y_centres[iy], mode='markers', name=str(level),
+            marker=dict(size=np.maximum(np.sqrt(n / largest) * max_marker, 3), color=color_map.get(level), opacity=0.6,
+                        line=dict(width=0)),
+            customdata=n.astype(int), hovertemplate=f"{level}: %{{customdata}} students<extra></extra>",
+        ))
+    fig.update_layout(xaxis_title=SCATTER_LABELS.get(x, x), yaxis_title=SCATTER_LABELS.get(y, y), legend_title_text=color_column)
+    return fig
+
+def attendance_scatter(df, color_map, max_points=None, mode=None):
+    """
+    Attendance vs. dropout probability by AI risk level. Up to `max_points` students are drawn
+    individually; above that the chart switches to `mode` ('density' or 'sample').
+    Returns (figure, mode used, payload bytes).
+    """
+    max_points = max_points or CHARTS['SCATTER_MAX_POINTS']
+    mode = mode or CHARTS['AGGREGATE_MODE']
+    if len(df) <= max_points:
+        mode = 'points'
+    if mode == 'density':
+        fig = binned_scatter(df, 'attendance', 'dropout_probability', 'ai_risk_level', color_map)
+    else:
+        points = df if mode == 'points' else stratified_sample(df, 'ai_risk_level', max_points)
+        fig = px.scatter(points, x='attendance', y='dropout_probability', color='ai_risk_level',
+                         color_discrete_map=color_map, labels=SCATTER_LABELS)
+    return fig, mode, payload_bytes(fig)
@@ -0,0 +1,114 @@
+# utils/cohort_index.py
+
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from config import COHORT_INDEX
+
+_BYTE_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def _popcount(bits):
+    if hasattr(np, 'bitwise_count'):
+        return int(np.bitwise_count(bits).sum(dtype=np.int64))
+    return int(_BYTE_POPCOUNT[bits].sum(dtype=np.int64))
+
+def _filter_key(filters):
+    """
+    Hashable, order-independent form of {column: selected values or None}. Values keep their type, so
+    1 and '1' get separate entries, just as they select different bitmaps.
+    """
+    return tuple(sorted((col, None if values is None else frozenset(values)) for col, values in filters.items()))
+
+class CohortIndex:
+    """
+    A scored cohort with a packed row bitmap per value of each filter column, so any filter
+    combination is an OR of bitmaps within a column and an AND across columns. Filtered views
+    and counts are memoized by filter state; a rerun with unchanged filters does no DataFrame work.
+    """
+    def __init__(self, df, columns=None, max_views=None):
+        self.df = df
+        self.n = len(df)
+        self.max_views = max_views or COHORT_INDEX['MAX_CACHED_VIEWS']
+        self.codes, self.values, self.bitmaps = {}, {}, {}
+        for col in (columns or COHORT_INDEX['COLUMNS']):
+            if col in df.columns:
+                self._index_column(col)
+        self._full = np.packbits(np.ones(self.n, dtype=bool))
+        self._views = OrderedDict()  # filter key -> (positions, view)
+        self._memo = {}
+        self._lock = threading.Lock()
+
+    def _index_column(self, col):
+        categorical = pd.Categorical(self.df[col])
+        codes = categorical.codes
+        present = np.flatnonzero(np.bincount(codes[codes >= 0], minlength=len(categorical.categories)))
+        self.codes[col] = codes
+        self.values[col] = [categorical.categories[i] for i in present]
+        self.bitmaps[col] = {categorical.categories[i]: np.packbits(codes == i) for i in present}
+
+    def options(self, col):
+        """Values of an indexed column that occur in the cohort, sorted."""
+        return sorted(self.values[col])
+
+    def _bits(self, filters):
+        bits = self._full
+        for col, values in filters.items():
+            if values is None:
+                continue
+            selected = np.zeros_like(self._full)
+            for value in values:
+                if value in self.bitmaps[col]:
+                    selected |= self.bitmaps[col][value]
+            bits = bits & selected
+        return bits
+
+    def positions(self, filters):
+        """Row positions matching `filters` ({indexed column: allowed values, or None for any})."""
+        return self.view(filters)[0]
+
+    def view(self, filters):
+        """(positions, filtered frame) for `filters`, memoized."""
+        key = _filter_key(filters)
+        with self._lock:
+            if key in self._views:
+                self._views.move_to_end(key)
+                return self._views[key]
+        positions = np.flatnonzero(np.unpackbits(self._bits(filters), count=self.n))
+        entry = (positions, self.df.iloc[positions])
+        with self._lock:
+            self._views[key] = entry
+            while len(self._views) > self.max_views:
+                self._views.popitem(last=False)
+        return entry
+
+    def count(self, filters):
+        """Number of rows matching `filters`, straight from the bitmaps."""
+        return _popcount(self._bits(filters))
+
+    def memoize(self, name, filters, compute):
+        """`compute()` cached under (name, filter state), e.g. for aggregates and chart figures."""
+        key = (name, _filter_key(filters))
+        if key not in self._memo:
+            if len(self._memo) >= self.max_views * 8:
+                self._memo.clear()
+            self._memo[key] = compute()
+        return self._memo[key]
+
+    def value_counts(self, col, filters):
+        """Counts of each value of `col` among rows matching `filters`, omitting values that do not occur."""
+        def compute():
+            if col in self.bitmaps:
+                bits = self._bits(filters)
+                counts = pd.Series({value: _popcount(bits & bitmap) for value, bitmap in self.bitmaps[col].items()}, dtype=np.int64)
+            else:
+                counts = self.view(filters)[1][col].value_counts()
+            return counts[counts > 0].sort_values(ascending=False, kind='stable')
+        return self.memoize(('value_counts', col), filters, compute)
+
+    def mean(self, col, filters):
+        """Mean of `col` over rows matching `filters` (0 when none match), memoized."""
+        def compute():
+            positions = self.positions(filters)
+            return float(np.nanmean(self.df[col].to_numpy()[positions])) if len(positions) else 0.0
+        return self.memoize(('mean', col), filters, compute)
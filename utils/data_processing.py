@@ -1,48 +1,262 @@
 # utils/data_processing.py
 
-import streamlit as st
+import contextvars
+import hashlib
+import io
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import pandas as pd
-import joblib
+import numpy as np
+from pandas.api.types import union_categoricals
+from config import INPUT_SCHEMA, REQUIRED_COLUMNS, INGESTION
+from utils.model_registry import get_model_registry
+from utils.runtime import report_error, report_warning
+from utils.instrumentation import instrumented
 
-@st.cache_data
-def load_and_merge_files(uploaded_files):
+try:
+    import pyarrow  # noqa: F401
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+try:
+    import python_calamine  # noqa: F401
+    HAS_CALAMINE = True
+except ImportError:
+    HAS_CALAMINE = False
+
+def _is_integer(dtype):
+    return dtype != 'category' and np.issubdtype(np.dtype(dtype), np.integer)
+
+def _read_dtypes(columns):
+    """Dtypes to parse with: integer columns are read as float32 so blanks and decimals survive until the merge."""
+    return {col: 'float32' if _is_integer(INPUT_SCHEMA[col]) else INPUT_SCHEMA[col] for col in columns if col in INPUT_SCHEMA}
+
+def _check_columns(file_name, columns):
+    missing = [col for col in REQUIRED_COLUMNS if col not in columns]
+    if missing:
+        raise ValueError(f"{file_name} is missing required column(s): {', '.join(missing)}")
+
+def _excel_engine():
+    engine = INGESTION['EXCEL_ENGINE']
+    if engine == 'auto':
+        return 'calamine' if HAS_CALAMINE else None  # None: pandas' default, openpyxl in read-only mode for .xlsx
+    return engine
+
+@instrumented('parse_file', rows=lambda frames: sum(map(len, frames)))
+def _read_file(name, buffer, use_schema):
+    """
+    Parses one upload into a list of frames. With `use_schema` they are schema-typed and a CSV header
+    is validated before any rows are parsed.
+    """
+    if name.endswith('.csv'):
+        if not use_schema:
+            return [pd.read_csv(buffer)]
+        columns = pd.read_csv(buffer, nrows=0).columns
+        _check_columns(name, columns)
+        buffer.seek(0)
+        dtypes = _read_dtypes(columns)
+        if HAS_PYARROW:
+            return [pd.read_csv(buffer, engine='pyarrow', dtype=dtypes)]
+        return list(pd.read_csv(buffer, dtype=dtypes, chunksize=INGESTION['CSV_CHUNK_SIZE']))
+    elif name.endswith(('.xls', '.xlsx')):
+        df = pd.read_excel(buffer, engine=_excel_engine())
+        if not use_schema:
+            return [df]
+        _check_columns(name, df.columns)
+        return [df.astype(_read_dtypes(df.columns))]
+    return []
+
+def _file_bytes(file):
+    return file.getvalue() if hasattr(file, 'getvalue') else file.read()
+
+class ParseCache:
+    """
+    LRU of parsed frames keyed by the SHA-256 of each file's bytes (and whether the schema was applied),
+    bounded by the frames' total size. Digests are remembered per Streamlit upload id, so a file that
+    stays in the uploader is neither re-read nor re-hashed on later runs; they are dropped with their entries.
+    """
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes or INGESTION['PARSE_CACHE_BYTES']
+        self._entries = OrderedDict()  # key -> (frames, nbytes)
+        self._digests = OrderedDict()  # upload file_id -> digest, least recently used first
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def digest(self, file):
+        """(digest, bytes) for `file`; bytes is None when the digest was remembered and the file not read."""
+        file_id = getattr(file, 'file_id', None)
+        with self._lock:
+            digest = self._digests.get(file_id) if file_id is not None else None
+            if digest is not None:
+                self._digests.move_to_end(file_id)
+                return digest, None
+        data = _file_bytes(file)
+        digest = hashlib.sha256(data).hexdigest()
+        if file_id is not None:
+            with self._lock:
+                self._digests[file_id] = digest
+                while len(self._digests) > INGESTION['PARSE_CACHE_UPLOADS']:
+                    self._digests.popitem(last=False)
+        return digest, data
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, frames):
+        nbytes = sum(int(f.memory_usage(index=True).sum()) for f in frames)
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = (frames, nbytes)
+            self._bytes += nbytes
+            evicted = False
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                self._bytes -= self._entries.popitem(last=False)[1][1]
+                evicted = True
+            if evicted:  # forget upload ids whose bytes are no longer cached (or never parsed)
+                live = {digest for digest, _ in self._entries}
+                for file_id in [f for f, digest in self._digests.items() if digest not in live]:
+                    del self._digests[file_id]
+
+    def stats(self):
+        return {'entries': len(self._entries), 'digests': len(self._digests), 'bytes': self._bytes, 'hits': self.hits, 'misses': self.misses}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._digests.clear()
+            self._bytes = 0
+
+_parse_cache = ParseCache()
+
+def get_parse_cache():
+    return _parse_cache
+
+def _parse_bytes(name, data, use_schema):
+    return _read_file(name, io.BytesIO(data), use_schema)
+
+def _parse_executor(n_jobs, max_workers):
+    """A pool for `n_jobs` parses per INGESTION['POOL'], or None when they should run inline."""
+    workers = min(max_workers or INGESTION['MAX_WORKERS'] or os.cpu_count() or 1, n_jobs)
+    if workers <= 1:
+        return None
+    if INGESTION['POOL'] == 'process':
+        return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(INGESTION['MP_START_METHOD']))
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ingest')
+
+@instrumented('merge_files', rows=len)
+def _merge_typed(frames):
+    """Concatenates typed chunks once, keeping categoricals categorical, then narrows integer columns."""
+    for col, dtype in INPUT_SCHEMA.items():
+        if dtype != 'category' or not all(col in f.columns for f in frames):
+            continue
+        categories = union_categoricals([f[col] for f in frames]).categories
+        for f in frames:
+            f[col] = f[col].cat.set_categories(categories)
+    merged_df = pd.concat(frames, ignore_index=True)
+    for col, dtype in INPUT_SCHEMA.items():
+        if col not in merged_df.columns or not _is_integer(dtype):
+            continue
+        values = merged_df[col].to_numpy()
+        info = np.iinfo(dtype)
+        if not np.isnan(values).any() and (values == np.round(values)).all() and values.min(initial=0) >= info.min and values.max(initial=0) <= info.max:
+            merged_df[col] = values.astype(dtype)
+    return merged_df
+
+@instrumented('load_and_merge_files', rows=len)
+def load_and_merge_files(uploaded_files, use_schema=False, source_column=None, max_workers=None):
     """
     Loads multiple CSV and Excel files, merges them, and returns a single DataFrame.
+    With `use_schema`, required columns are checked up front and INPUT_SCHEMA dtypes are applied while parsing.
+    With `source_column`, each row is tagged with its file's name (without extension) unless the file has that column.
+    Files whose bytes are not in the parse cache are parsed concurrently, on INGESTION['POOL'].
     """
     if not uploaded_files:
         return None
-    
-    dataframes = []
+
+    # Only files whose bytes are not in the parse cache are parsed, concurrently when there are several.
+    cache = get_parse_cache()
+    keys, parsed, pending = [], {}, {}
     for file in uploaded_files:
-        try:
-            if file.name.endswith('.csv'):
-                df = pd.read_csv(file)
-                dataframes.append(df)
-            elif file.name.endswith(('.xls', '.xlsx')):
-                df = pd.read_excel(file)
-                dataframes.append(df)
-        except Exception as e:
-            st.error(f"Error reading {file.name}: {e}")
-            return None
-            
+        digest, data = cache.digest(file)
+        key = (digest, bool(use_schema))
+        keys.append((file, key))
+        if key in parsed or key in pending:
+            continue
+        frames = cache.get(key)
+        if frames is not None:
+            parsed[key] = frames
+        else:
+            pending[key] = (file.name, data if data is not None else _file_bytes(file))
+
+    executor = _parse_executor(len(pending), max_workers)
+    try:
+        if executor is not None:
+            # Thread tasks run in a copy of the context so their stages land in the current run.
+            submit = executor.submit if isinstance(executor, ProcessPoolExecutor) else (
+                lambda *args: executor.submit(contextvars.copy_context().run, *args))
+            futures = {key: submit(_parse_bytes, name, data, use_schema) for key, (name, data) in pending.items()}
+        for key, (name, data) in pending.items():
+            try:
+                parsed[key] = futures[key].result() if executor is not None else _parse_bytes(name, data, use_schema)
+            except Exception as e:
+                report_error(f"Error reading {name}: {e}")
+                return None
+            cache.put(key, parsed[key])
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    dataframes = []
+    for file, key in keys:
+        frames = [f.copy(deep=False) for f in parsed[key]]  # cached frames are shared; tag and merge copies
+        if source_column:
+            source = os.path.splitext(os.path.basename(file.name))[0]
+            for f in frames:
+                if source_column not in f.columns:
+                    f[source_column] = source
+        dataframes.extend(frames)
+
     if not dataframes:
-        st.warning("No valid files were processed.")
+        report_warning("No valid files were processed.")
         return None
         
     try:
-        merged_df = pd.concat(dataframes, ignore_index=True)
+        merged_df = _merge_typed(dataframes) if use_schema else pd.concat(dataframes, ignore_index=True)
+        if source_column in merged_df.columns:
+            merged_df[source_column] = merged_df[source_column].astype('category')
         return merged_df
     except Exception as e:
-        st.error(f"Failed to merge files. Ensure columns match. Error: {e}")
+        report_error(f"Failed to merge files. Ensure columns match. Error: {e}")
         return None
 
-@st.cache_resource
-def load_model(_uploaded_file):
+@instrumented('load_model')
+def load_model_with_info(uploaded_file):
     """
-    Loads a joblib model from an uploaded file.
+    Loads a joblib model from an uploaded file through the content-addressed model registry.
+    Returns (model, ModelInfo), or (None, None) if the file cannot be loaded.
     """
     try:
-        return joblib.load(_uploaded_file)
+        data = uploaded_file.getvalue() if hasattr(uploaded_file, 'getvalue') else uploaded_file.read()
+        return get_model_registry().load_bytes(data)
     except Exception as e:
-        st.error(f"Error loading model file: {e}")
-        return None
\ No newline at end of file
+        report_error(f"Error loading model file: {e}")
+        return None, None
+
+def load_model(uploaded_file):
+    """
+    Loads a joblib model from an uploaded file.
+    """
+    return load_model_with_info(uploaded_file)[0]
@@ -1,37 +1,232 @@
 # utils/email_sender.py
 
-import streamlit as st
+import contextvars
 import smtplib
+import socket
+import threading
+import time
+import queue
+from dataclasses import dataclass
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
+from config import EMAIL_SETTINGS
+from utils.runtime import get_secret, report_error, report_warning
+from utils.instrumentation import stage
 
-def send_email_with_attachment(recipient_email, subject, body, pdf_data, student_name, report_type):
-    """Securely sends an email with the PDF report attached."""
-    try:
-        if 'sender_email' not in st.secrets or 'sender_password' not in st.secrets:
-            st.error("Email credentials are not configured in secrets.toml. Cannot send email.")
-            return False
+@dataclass
+class EmailJob:
+    recipient_email: str
+    subject: str
+    body: str
+    pdf_data: bytes
+    student_name: str
+    report_type: str
+
+@dataclass
+class EmailResult:
+    student_name: str
+    recipient_email: str
+    success: bool
+    error: str = None
+    attempts: int = 0
 
-        sender_email = st.secrets["sender_email"]
-        sender_password = st.secrets["sender_password"]
+def get_sender_credentials():
+    """Returns (sender_email, sender_password) from secrets.toml or the SENDER_EMAIL/SENDER_PASSWORD environment variables, or (None, None)."""
+    sender_email, sender_password = get_secret("sender_email"), get_secret("sender_password")
+    if sender_email is None or sender_password is None:
+        return None, None
+    return sender_email, sender_password
 
-        msg = MIMEMultipart()
-        msg['From'] = sender_email
-        msg['To'] = recipient_email
-        msg['Subject'] = subject
-        msg.attach(MIMEText(body, 'plain'))
+def build_report_message(sender_email, recipient_email, subject, body, pdf_data, student_name, report_type):
+    """Builds the MIME message carrying a single PDF report."""
+    msg = MIMEMultipart()
+    msg['From'] = sender_email
+    msg['To'] = recipient_email
+    msg['Subject'] = subject
+    msg.attach(MIMEText(body, 'plain'))
 
-        pdf_attachment = MIMEApplication(pdf_data, _subtype="pdf")
-        pdf_attachment.add_header('Content-Disposition', 'attachment', filename=f"{report_type}_Report_{student_name.replace(' ', '_')}.pdf")
-        msg.attach(pdf_attachment)
+    pdf_attachment = MIMEApplication(pdf_data, _subtype="pdf")
+    pdf_attachment.add_header('Content-Disposition', 'attachment', filename=f"{report_type}_Report_{student_name.replace(' ', '_')}.pdf")
+    msg.attach(pdf_attachment)
+    return msg
 
-        with smtplib.SMTP('smtp.gmail.com', 587) as server:
-            server.starttls()
-            server.login(sender_email, sender_password)
-            server.send_message(msg)
-        
+def is_transient_smtp_error(exc):
+    """True for failures worth retrying on a fresh connection (drops, timeouts, 4xx replies)."""
+    if isinstance(exc, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
         return True
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return 400 <= exc.smtp_code < 500
+    if isinstance(exc, smtplib.SMTPException):
+        return False
+    return isinstance(exc, (ConnectionError, socket.timeout, TimeoutError))
+
+class RateLimiter:
+    """Spaces calls so that at most `rate` pass per second across all threads sharing it."""
+    def __init__(self, rate):
+        self._interval = 1.0 / rate if rate and rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self._interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._next = max(self._next, now)
+            wait = self._next - now
+            self._next += self._interval
+        if wait > 0:
+            time.sleep(wait)
+
+class SMTPSession:
+    """An authenticated SMTP connection that is opened lazily and reused for many messages."""
+    def __init__(self, sender_email, sender_password, settings=None):
+        self.settings = {**EMAIL_SETTINGS, **(settings or {})}
+        self.sender_email = sender_email
+        self.sender_password = sender_password
+        self._limiter = RateLimiter(self.settings['PER_CONNECTION_RATE'])
+        self._server = None
+        self._sent = 0
+
+    def _connect(self):
+        with stage('smtp_connect'):
+            self._open()
+
+    def _open(self):
+        server = smtplib.SMTP(self.settings['SMTP_HOST'], self.settings['SMTP_PORT'], timeout=self.settings['TIMEOUT'])
+        try:
+            if self.settings['USE_STARTTLS']:
+                server.starttls()
+            if self.sender_password:
+                server.login(self.sender_email, self.sender_password)
+        except Exception:
+            server.close()
+            raise
+        self._server = server
+        self._sent = 0
+
+    def send(self, msg):
+        if self._server is not None and self._sent >= self.settings['MAX_MESSAGES_PER_CONNECTION']:
+            self.close()
+        if self._server is None:
+            self._connect()
+        self._limiter.acquire()
+        with stage('smtp_send', rows=1):
+            self._server.send_message(msg)
+        self._sent += 1
+
+    def close(self):
+        if self._server is None:
+            return
+        try:
+            self._server.quit()
+        except Exception:
+            self._server.close()
+        self._server = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def _deliver(session, job, global_limiter, max_retries):
+    result = EmailResult(job.student_name, job.recipient_email, success=False)
+    msg = build_report_message(session.sender_email, job.recipient_email, job.subject, job.body, job.pdf_data, job.student_name, job.report_type)
+    while True:
+        result.attempts += 1
+        try:
+            global_limiter.acquire()
+            session.send(msg)
+            result.success = True
+            return result
+        except Exception as e:
+            result.error = str(e) or type(e).__name__
+            # A failed exchange can leave the connection in an unknown state; start over on the next message.
+            session.close()
+            if not is_transient_smtp_error(e) or result.attempts > max_retries:
+                return result
+            time.sleep(min(2 ** (result.attempts - 1), 10))
+
+def send_bulk_emails(jobs, sender_email, sender_password, settings=None, progress_callback=None):
+    """
+    Sends report emails from a small pool of worker threads, each reusing one SMTP session.
+    `jobs` may be a lazy iterable of EmailJob, so reports can still be rendering while earlier
+    ones are sent. `progress_callback(result, n_done)` runs on the calling thread.
+    Returns one EmailResult per job, in completion order.
+    """
+    settings = {**EMAIL_SETTINGS, **(settings or {})}
+    pool_size = max(1, int(settings['POOL_SIZE']))
+    global_limiter = RateLimiter(settings['GLOBAL_RATE'])
+    job_queue = queue.Queue(maxsize=pool_size * 2)
+    result_queue = queue.Queue()
+    results = []
+
+    def worker():
+        with SMTPSession(sender_email, sender_password, settings) as session:
+            while True:
+                job = job_queue.get()
+                if job is None:
+                    return
+                try:
+                    result = _deliver(session, job, global_limiter, settings['MAX_RETRIES'])
+                except Exception as e:
+                    result = EmailResult(job.student_name, job.recipient_email, False, str(e), 1)
+                result_queue.put(result)
+
+    def drain(block=False):
+        while True:
+            try:
+                result = result_queue.get(timeout=0.1) if block else result_queue.get_nowait()
+            except queue.Empty:
+                return
+            results.append(result)
+            if progress_callback:
+                progress_callback(result, len(results))
+            block = False
+
+    # Each worker runs in a copy of the caller's context so its SMTP timings land in the caller's run.
+    threads = [threading.Thread(target=contextvars.copy_context().run, args=(worker,), name=f"smtp-worker-{i}", daemon=True)
+               for i in range(pool_size)]
+    for t in threads:
+        t.start()
+    try:
+        for job in jobs:
+            while True:
+                try:
+                    job_queue.put(job, timeout=0.1)
+                    break
+                except queue.Full:
+                    drain()
+            drain()
+    finally:
+        for _ in threads:
+            job_queue.put(None)
+        while any(t.is_alive() for t in threads):
+            drain(block=True)
+        drain()
+    return results
+
+def send_email_with_attachment(recipient_email, subject, body, pdf_data, student_name, report_type, term=None):
+    """
+    Queues an email with the PDF report attached in the persistent outbox and makes sure the
+    background worker is delivering. Returns False if credentials are missing or this report was
+    already queued or sent to the student this term.
+    """
+    from utils.outbox import current_term, get_outbox
+    try:
+        sender_email, sender_password = get_sender_credentials()
+        if sender_email is None:
+            report_error("Email credentials are not configured in secrets.toml. Cannot send email.")
+            return False
+
+        outbox = get_outbox()
+        queued = outbox.enqueue(EmailJob(recipient_email, subject, body, pdf_data, student_name, report_type), term)
+        outbox.start_worker(sender_email, sender_password)
+        if not queued:
+            report_warning(f"A {report_type.replace('_', ' ')} report for {student_name} is already queued or sent for term {term or current_term()}.")
+        return queued
     except Exception as e:
-        st.error(f"Failed to send email to {recipient_email}: {e}")
-        return False
\ No newline at end of file
+        report_error(f"Failed to queue email to {recipient_email}: {e}")
+        return False
@@ -1,37 +1,291 @@
 # utils/expert_system.py
 
-import pandas as pd
+import json
+import hashlib
 import numpy as np
-import streamlit as st
-from config import THRESHOLDS # Import thresholds from the config file
-
-def generate_dropout_report(input_df):
-    df = input_df.copy()
-    required_mappings = {
-        'current_test_score': 'Marks', 'previous_test_score': 'Previous Score', 'attendance': 'Attendance (%)',
-    }
-    for source, target in required_mappings.items():
-        if source not in df.columns: st.error(f"Error: Missing column '{source}'"); st.stop()
-        df[target] = df[source]
-    if 'Average Study Hour' not in df.columns: df['Average Study Hour'] = 2
-    df['Fees Status'] = 'Unknown'
-    if 'fees' in df.columns: df['Fees Status'] = np.where(df['fees'] == 1, 'Paid', 'Unpaid')
-    score_drop = df['Previous Score'] - df['Marks']
-    score_improvement = df['Marks'] - df['Previous Score']
-    is_disengaged = (df['Marks'] < THRESHOLDS['MARKS_FAILING']) & (df['Attendance (%)'] < THRESHOLDS['ATTENDANCE_CRITICAL'])
-    is_high_achiever_crisis = (df['Previous Score'] > THRESHOLDS['PREVIOUS_SCORE_HIGH']) & (score_drop > THRESHOLDS['SCORE_DROP_SIGNIFICANT']) & (df['Attendance (%)'] < THRESHOLDS['ATTENDANCE_POOR'])
-    is_silent_struggler = (df['Marks'] < THRESHOLDS['MARKS_FAILING']) & (df['Attendance (%)'] > THRESHOLDS['ATTENDANCE_POOR']) & (df['Average Study Hour'] >= THRESHOLDS['STUDY_HOURS_HIGH'])
-    warning_count = ((df['Marks'] <= THRESHOLDS['MARKS_BORDERLINE']).astype(int) + (df['Attendance (%)'] <= THRESHOLDS['ATTENDANCE_POOR']).astype(int) + (df['Average Study Hour'] <= THRESHOLDS['STUDY_HOURS_LOW']).astype(int) + (df['Fees Status'] == 'Unpaid').astype(int))
-    is_coasting = (warning_count >= 2)
-    is_declining = (score_drop > THRESHOLDS['SCORE_DROP_MODERATE']) & (df['Attendance (%)'] < THRESHOLDS['ATTENDANCE_POOR'])
-    is_fee_risk = (df['Fees Status'] == 'Unpaid')
-    has_positive_momentum = (score_improvement > 10) & (df['Attendance (%)'] > THRESHOLDS['ATTENDANCE_POOR'])
-    is_stable_performer = (df['Marks'] > THRESHOLDS['MARKS_GOOD']) & (df['Attendance (%)'] > THRESHOLDS['ATTENDANCE_POOR'])
-    conditions = [is_disengaged, is_high_achiever_crisis, is_silent_struggler, is_coasting, is_declining, is_fee_risk, has_positive_momentum, is_stable_performer]
-    outcomes_status = ['Dropout', 'Dropout', 'Dropout', 'Medium', 'Medium', 'Medium', 'Not Dropout', 'Not Dropout']
-    outcomes_reason = ['Disengaged Student', 'High-Achiever in Crisis', 'Silent Struggler', 'Coasting (Multiple warnings)', 'Declining Performer', 'Administrative Risk (Fees)', 'Positive Momentum', 'Stable Performer']
-    outcomes_suggestion = ['Suggestion: Immediate, direct intervention required.', 'Suggestion: Urgent, sensitive mentoring needed.', 'Suggestion: Provide academic support.', 'Suggestion: Schedule a check-in.', 'Suggestion: Proactive counseling to reverse the trend.', 'Suggestion: Alert student and guardian about fee status.', 'Suggestion: Acknowledge and encourage progress.', 'Suggestion: Continue standard monitoring.']
-    df['expert_status'] = np.select(conditions, outcomes_status, default='Not Dropout')
-    df['expert_reason'] = np.select(conditions, outcomes_reason, default='Low Risk Profile')
-    df['expert_suggestion'] = np.select(conditions, outcomes_suggestion, default='Suggestion: Continue standard monitoring.')
-    return df[['expert_status', 'expert_reason', 'expert_suggestion']]
\ No newline at end of file
+import pandas as pd
+from config import THRESHOLDS, EXPERT_RULES, EXPERT_DERIVED_FEATURES, EXPERT_INPUT_DEFAULTS, EXPERT_DEFAULT_OUTCOME, SENSITIVITY
+from utils.runtime import report_error, stop
+from utils.instrumentation import instrumented
+
+COMPARISONS = {'<': np.less, '<=': np.less_equal, '>': np.greater, '>=': np.greater_equal, '==': np.equal, '!=': np.not_equal}
+ARITHMETIC = {'-': np.subtract, '+': np.add}
+OUTCOME_FIELDS = ['status', 'reason', 'suggestion']
+
+def _column_values(df, name):
+    """The column as a NumPy array, without a copy for plain numeric columns."""
+    series = df[name]
+    if isinstance(series.dtype, np.dtype) and series.dtype.kind in 'biuf':
+        return series.to_numpy()
+    return series.to_numpy(dtype=np.float64, na_value=np.nan)
+
+def _mask_dtype(n_rules):
+    for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+        if n_rules <= np.iinfo(dtype).bits:
+            return dtype
+    raise ValueError(f"At most 64 rules can be tracked in a bitmask, got {n_rules}")
+
+class RuleSet:
+    """
+    Expert rules compiled once into flat condition/outcome tables.
+    Evaluation reads the needed columns as arrays, computes every distinct condition once and
+    resolves all rules in a single pass, returning categorical status/reason/suggestion columns.
+    """
+    def __init__(self, rules, thresholds, derived=None, defaults=None, default_outcome=None):
+        self.rules = list(rules)
+        self.thresholds = dict(thresholds)
+        self.derived = dict(derived or {})
+        self.defaults = dict(defaults or {})
+        default_outcome = default_outcome or EXPERT_DEFAULT_OUTCOME
+        self.rule_names = [rule.get('name', f'rule_{i}') for i, rule in enumerate(self.rules)]
+        self.mask_dtype = _mask_dtype(len(self.rules))
+
+        self.conditions = []  # distinct (feature, operator, value) triples
+        self.condition_thresholds = []  # THRESHOLDS key each condition's value came from, or None
+        self._condition_ids = {}
+        self.rule_conditions = [[self._condition(*cond) for cond in rule['when']] for rule in self.rules]
+        self.derived_conditions = {
+            name: [self._condition(*cond) for cond in spec['count']]
+            for name, spec in self.derived.items() if isinstance(spec, dict)
+        }
+
+        # Outcome i belongs to rule i; the final outcome is the default when no rule fires.
+        outcomes = self.rules + [default_outcome]
+        self.categories, self.outcome_codes = {}, {}
+        for field in OUTCOME_FIELDS:
+            values = [outcome[field] for outcome in outcomes]
+            categories = list(dict.fromkeys(values))
+            self.categories[field] = categories
+            self.outcome_codes[field] = np.array([categories.index(v) for v in values], dtype=np.int16)
+        self.input_columns = self._input_columns()
+
+    def _condition(self, feature, operator, value):
+        if operator not in COMPARISONS:
+            raise ValueError(f"Unknown operator '{operator}' in condition on '{feature}'")
+        threshold = None
+        if isinstance(value, str):
+            if value not in self.thresholds:
+                raise ValueError(f"Unknown threshold '{value}' in condition on '{feature}'")
+            threshold, value = value, self.thresholds[value]
+        key = (feature, operator, value, threshold)
+        if key not in self._condition_ids:
+            self._condition_ids[key] = len(self.conditions)
+            self.conditions.append(key[:3])
+            self.condition_thresholds.append(threshold)
+        return self._condition_ids[key]
+
+    def _input_columns(self):
+        columns, pending = [], [feature for feature, _, _ in self.conditions]
+        while pending:
+            name = pending.pop()
+            spec = self.derived.get(name)
+            if isinstance(spec, list):
+                pending.extend([spec[0], spec[2]])
+            elif isinstance(spec, dict):
+                pending.extend(self.conditions[i][0] for i in self.derived_conditions[name])
+            elif name not in columns:
+                columns.append(name)
+        return columns
+
+    @property
+    def fingerprint(self):
+        """Hash of everything that decides the outcome, so cached results can be tied to one rule version."""
+        spec = [self.rules, self.thresholds, self.derived, self.defaults, [self.categories[f] for f in OUTCOME_FIELDS]]
+        return hashlib.sha256(json.dumps(spec, sort_keys=True, default=str).encode()).hexdigest()
+
+    @property
+    def required_columns(self):
+        """Input columns that have no default and must be present."""
+        return [col for col in self.input_columns if col not in self.defaults]
+
+    def _evaluator(self, df):
+        n = len(df)
+        features, conditions = {}, {}
+
+        def feature(name):
+            if name not in features:
+                spec = self.derived.get(name)
+                if isinstance(spec, list):
+                    left, op, right = spec
+                    features[name] = ARITHMETIC[op](feature(left), feature(right), dtype=np.float64)
+                elif isinstance(spec, dict):
+                    counts = np.zeros(n, dtype=np.int8)
+                    for cid in self.derived_conditions[name]:
+                        counts += condition(cid)
+                    features[name] = counts
+                elif name in df.columns:
+                    features[name] = _column_values(df, name)
+                else:
+                    features[name] = np.full(n, self.defaults[name])
+            return features[name]
+
+        def condition(cid):
+            if cid not in conditions:
+                name, op, value = self.conditions[cid]
+                conditions[cid] = COMPARISONS[op](feature(name), value)
+            return conditions[cid]
+
+        return condition, feature
+
+    def rule_indices(self, df, return_mask=False):
+        """
+        Index of the first rule that fires for each row (len(rules) when none does),
+        plus, with `return_mask`, a bitmask of every rule that fired (bit i = rule i).
+        """
+        n, n_rules = len(df), len(self.rules)
+        condition, _ = self._evaluator(df)
+        rule_index = np.full(n, n_rules, dtype=np.int16)
+        mask = np.zeros(n, dtype=self.mask_dtype) if return_mask else None
+        # Walking the rules backwards lets earlier rules overwrite later ones: first match wins.
+        for i in range(n_rules - 1, -1, -1):
+            fired = np.ones(n, dtype=bool)
+            for cid in self.rule_conditions[i]:
+                fired &= condition(cid)
+            rule_index[fired] = i
+            if return_mask:
+                mask |= fired.astype(self.mask_dtype) << self.mask_dtype(i)
+        return rule_index, mask
+
+    def outcomes(self, rule_index, index=None):
+        """Builds the categorical expert_status/reason/suggestion columns from rule indices."""
+        return pd.DataFrame({
+            f'expert_{field}': pd.Categorical.from_codes(self.outcome_codes[field][rule_index], self.categories[field])
+            for field in OUTCOME_FIELDS
+        }, index=index)
+
+    def evaluate(self, df, return_mask=False):
+        rule_index, mask = self.rule_indices(df, return_mask)
+        result = self.outcomes(rule_index, df.index)
+        if return_mask:
+            result['expert_rule_mask'] = mask
+        return result
+
+    def _depends_on_count(self, name):
+        spec = self.derived.get(name)
+        if isinstance(spec, dict):
+            return True
+        return isinstance(spec, list) and (self._depends_on_count(spec[0]) or self._depends_on_count(spec[2]))
+
+    def sweep(self, df, grid, field='status', chunk_cells=None):
+        """
+        Counts rows per outcome `field` value for every combination of the threshold values in `grid`
+        ({THRESHOLDS key: values}); other thresholds keep their compiled values. Returns one row per
+        combination: the swept values, then a count column per category.
+
+        Each condition on a swept threshold is evaluated on its feature's distinct values against the
+        whole value list, and each row keeps only the index of its truth pattern. Rows sharing every
+        pattern (their signature) resolve the same way, so the rules run once per distinct signature
+        and grid point and the counts are weighted by how many rows share it.
+        """
+        names = list(grid)
+        unknown = [name for name in names if name not in self.thresholds]
+        if unknown:
+            raise ValueError(f"Unknown threshold(s): {', '.join(unknown)}")
+        values = [np.unique(np.asarray(grid[name])) for name in names]
+        points = np.indices([len(v) for v in values]).reshape(len(names), -1)  # value index per name, per grid point
+        swept = {name: i for i, name in enumerate(names)}
+        condition, feature = self._evaluator(df)
+
+        # Plain-feature conditions become per-row pattern codes; conditions on counts are resolved per grid point.
+        base, patterns, codes = {}, [], []
+        for cid, (name, op, value) in enumerate(self.conditions):
+            if name in self.derived_conditions:
+                continue
+            if self._depends_on_count(name):
+                raise ValueError(f"Cannot sweep conditions on '{name}', which is computed from a count")
+            threshold = self.condition_thresholds[cid]
+            if threshold in swept:
+                distinct, inverse = np.unique(feature(name), return_inverse=True)
+                table = COMPARISONS[op](distinct[:, None], values[swept[threshold]][None, :])
+                table, pattern = np.unique(table, axis=0, return_inverse=True)
+                code = pattern.reshape(-1)[inverse]
+            else:
+                table, code = np.array([[False], [True]]), condition(cid).astype(np.int64)
+            base[cid] = len(patterns)
+            patterns.append(table)
+            codes.append(code)
+
+        radices = [len(table) for table in patterns]
+        if float(np.prod(radices, dtype=np.float64)) < 2 ** 62:
+            multipliers = np.cumprod([1] + radices[:-1], dtype=np.int64)
+            keys = sum(code * m for code, m in zip(codes, multipliers)) if codes else np.zeros(len(df), dtype=np.int64)
+            keys, weights = np.unique(keys, return_counts=True)
+            signatures = (keys[:, None] // multipliers[None, :]) % np.array(radices, dtype=np.int64)[None, :]
+        else:
+            signatures, weights = np.unique(np.stack(codes, axis=1), axis=0, return_counts=True)
+
+        n_sig, n_points = len(signatures), points.shape[1]
+        categories = self.categories[field]
+        outcome_codes = self.outcome_codes[field]
+        counts = np.zeros((n_points, len(categories)), dtype=np.int64)
+        step = max(1, (chunk_cells or SENSITIVITY['CHUNK_CELLS']) // max(n_sig, 1))
+        for start in range(0, n_points, step):
+            chunk = points[:, start:start + step]
+            truth = {}
+
+            def holds(cid):
+                if cid not in truth:
+                    name, op, value = self.conditions[cid]
+                    threshold = self.condition_thresholds[cid]
+                    if cid in base:
+                        table = patterns[base[cid]][signatures[:, base[cid]]]
+                        truth[cid] = table[:, chunk[swept[threshold]]] if threshold in swept else table
+                    else:
+                        total = sum(holds(sub).astype(np.int8) for sub in self.derived_conditions[name])
+                        limit = values[swept[threshold]][chunk[swept[threshold]]][None, :] if threshold in swept else value
+                        truth[cid] = COMPARISONS[op](total, limit)
+                return truth[cid]
+
+            rule_index = np.full((n_sig, chunk.shape[1]), len(self.rules), dtype=np.int16)
+            for i in range(len(self.rules) - 1, -1, -1):
+                fired = np.ones_like(rule_index, dtype=bool)
+                for cid in self.rule_conditions[i]:
+                    fired &= holds(cid)
+                rule_index[fired] = i
+            outcome = outcome_codes[rule_index]
+            for c in range(len(categories)):
+                counts[start:start + chunk.shape[1], c] = weights @ (outcome == c)
+
+        result = pd.DataFrame({name: values[i][points[i]] for i, name in enumerate(names)})
+        for c, category in enumerate(categories):
+            result[category] = counts[:, c]
+        return result
+
+def compile_rules(rules=None, thresholds=None, derived=None, defaults=None, default_outcome=None):
+    """Compiles rule data (EXPERT_RULES and friends from config by default) into a RuleSet."""
+    return RuleSet(
+        EXPERT_RULES if rules is None else rules,
+        THRESHOLDS if thresholds is None else thresholds,
+        EXPERT_DERIVED_FEATURES if derived is None else derived,
+        EXPERT_INPUT_DEFAULTS if defaults is None else defaults,
+        default_outcome,
+    )
+
+def load_rules(path, thresholds=None):
+    """Compiles a JSON rules file with 'rules' and optional 'derived', 'defaults' and 'default_outcome' keys."""
+    with open(path) as f:
+        spec = json.load(f)
+    return compile_rules(spec['rules'], thresholds, spec.get('derived'), spec.get('defaults'), spec.get('default_outcome'))
+
+_default_ruleset = None
+
+def get_default_ruleset():
+    global _default_ruleset
+    if _default_ruleset is None:
+        _default_ruleset = compile_rules()
+    return _default_ruleset
+
+@instrumented('rule_engine', rows=len)
+def generate_dropout_report(input_df, ruleset=None, return_mask=False):
+    ruleset = ruleset or get_default_ruleset()
+    for col in ruleset.required_columns:
+        if col not in input_df.columns: report_error(f"Error: Missing column '{col}'"); stop()
+    return ruleset.evaluate(input_df, return_mask)
+
+@instrumented('threshold_sweep', rows=len)
+def sweep_thresholds(input_df, grid, ruleset=None, field='status'):
+    """What-if counts per expert_<field> value over a grid of threshold values (see RuleSet.sweep)."""
+    ruleset = ruleset or get_default_ruleset()
+    for col in ruleset.required_columns:
+        if col not in input_df.columns: report_error(f"Error: Missing column '{col}'"); stop()
+    return ruleset.sweep(input_df, grid, field)
@@ -0,0 +1,171 @@
+# utils/history.py
+
+"""
+Append-only history of scored cohorts, stored as a hive-partitioned Parquet dataset:
+
+    history_store/term=2026-H2/class=class_A_data/run=20261017T101500482913-3f9a1c/part-....parquet
+
+Queries go through pyarrow.dataset: filters on term/class/run skip whole directories, a filter on
+`student` skips row groups by their min/max statistics (rows are written sorted by student), and
+only the requested columns are read from disk.
+"""
+
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta
+import pandas as pd
+from config import HISTORY, INPUT_SCHEMA
+from utils.instrumentation import stage
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+PARTITION_COLUMNS = ['term', 'class', 'run']
+# Level order for transition matrices, from least to most at risk.
+LEVEL_ORDER = {'ai_risk_level': ['Low', 'Medium', 'High'], 'expert_status': ['Not Dropout', 'Medium', 'Dropout']}
+TRAJECTORY_COLUMNS = ['run_at', 'dropout_probability', 'ai_risk_level', 'expert_status']
+_FLOAT_COLUMNS = {'dropout_probability'}
+_CATEGORY_COLUMNS = {'ai_risk_level', 'expert_status', 'expert_reason'}
+
+_last_run_start = None
+_run_id_lock = threading.Lock()
+
+def new_run_id(now=None):
+    """
+    Run id that sorts by start time: the local time to the microsecond (kept strictly increasing within
+    the process) plus a short random suffix so ids from different processes cannot collide.
+    """
+    global _last_run_start
+    if now is None:
+        with _run_id_lock:
+            now = datetime.now()
+            if _last_run_start is not None and now <= _last_run_start:
+                now = _last_run_start + timedelta(microseconds=1)
+            _last_run_start = now
+    return f"{now:%Y%m%dT%H%M%S%f}-{uuid.uuid4().hex[:6]}"
+
+def run_time(run_id):
+    stamp = run_id.split('-', 1)[0]  # ids written before microseconds were added have 15 characters
+    return pd.to_datetime(stamp, format='%Y%m%dT%H%M%S%f' if len(stamp) > 15 else '%Y%m%dT%H%M%S', errors='coerce')
+
+def _partitioning():
+    return ds.partitioning(pa.schema([(name, pa.string()) for name in PARTITION_COLUMNS]), flavor='hive')
+
+def _history_frame(df, term, run_id, model_sha=None):
+    """The columns kept per run in compact dtypes: categories become dictionaries, floats float32."""
+    name_column = 'Student_Name' if 'Student_Name' in df.columns else 'Student Name'
+    out = pd.DataFrame({'student': df[name_column].astype(str).to_numpy()})
+    if 'student_email' in df.columns:
+        out['student_email'] = df['student_email'].astype('string').array
+    for col in HISTORY['COLUMNS']:
+        if col not in df.columns:
+            continue
+        values = df[col]
+        if col in _CATEGORY_COLUMNS:
+            values = values.astype('category')
+        elif col in _FLOAT_COLUMNS:
+            values = values.astype('float32')
+        elif col in INPUT_SCHEMA and not values.isna().any():
+            values = values.astype(INPUT_SCHEMA[col])
+        out[col] = values.array
+    out['model'] = pd.Categorical([model_sha[:12] if model_sha else ''] * len(out))
+    out['run_at'] = run_time(run_id)
+    class_column = HISTORY['CLASS_COLUMN']
+    classes = df[class_column].astype(object).fillna('all').astype(str).to_numpy() if class_column in df.columns else 'all'
+    out['term'], out['class'], out['run'] = term, classes, run_id
+    return out.sort_values(['class', 'student'], kind='stable', ignore_index=True)
+
+def _isin(column, values):
+    if values is None:
+        return None
+    return ds.field(column).isin([values] if isinstance(values, str) else list(values))
+
+def transition_counts(pairs):
+    """Students per (from level, to level) from `compare_runs` output; all levels appear, in risk order."""
+    return pd.crosstab(pairs['from'], pairs['to'], dropna=False)
+
+class HistoryStore:
+    """Appends scored cohorts to, and queries them from, the partitioned dataset under `root`."""
+    def __init__(self, root=None):
+        self.root = root or HISTORY['ROOT_DIR']
+
+    def append(self, df, term, run_id=None, model_sha=None):
+        """Writes one run (one file per class) and returns its run id."""
+        run_id = run_id or new_run_id()
+        with stage('history_append', rows=len(df)):
+            table = pa.Table.from_pandas(_history_frame(df, term, run_id, model_sha), preserve_index=False)
+            ds.write_dataset(table, self.root, format='parquet', partitioning=_partitioning(),
+                             basename_template=f"part-{run_id}-{{i}}.parquet",
+                             existing_data_behavior='overwrite_or_ignore', preserve_order=True,
+                             max_rows_per_group=HISTORY['ROW_GROUP_SIZE'],
+                             file_options=ds.ParquetFileFormat().make_write_options(compression='zstd'))
+        return run_id
+
+    def _dataset(self):
+        if not os.path.isdir(self.root):
+            return None
+        return ds.dataset(self.root, format='parquet', partitioning=_partitioning())
+
+    def _filter(self, term=None, classes=None, runs=None, students=None):
+        expression = None
+        for part in (_isin('term', term), _isin('class', classes), _isin('run', runs), _isin('student', students)):
+            if part is not None:
+                expression = part if expression is None else expression & part
+        return expression
+
+    def runs(self, term=None):
+        """One row per run (term, classes, students, run_at), oldest first; reads only Parquet footers."""
+        dataset = self._dataset()
+        rows = []
+        if dataset is not None:
+            for fragment in dataset.get_fragments(filter=self._filter(term)):
+                rows.append({**ds.get_partition_keys(fragment.partition_expression), 'students': fragment.count_rows()})
+        if not rows:
+            return pd.DataFrame(columns=['run', 'term', 'classes', 'students', 'run_at'])
+        runs = (pd.DataFrame(rows).groupby(['run', 'term'], as_index=False)
+                .agg(classes=('class', lambda c: sorted(set(c))), students=('students', 'sum')))
+        runs['run_at'] = runs['run'].map(run_time)
+        return runs.sort_values('run', ignore_index=True)
+
+    def read(self, columns=None, term=None, classes=None, runs=None, students=None):
+        """Rows matching the filters, reading only `columns` (partition columns included on request)."""
+        dataset = self._dataset()
+        if dataset is None:
+            return pd.DataFrame(columns=columns or [])
+        with stage('history_query') as frame:
+            table = dataset.to_table(columns=columns, filter=self._filter(term, classes, runs, students))
+            frame.rows = table.num_rows
+            return table.to_pandas()
+
+    def trajectory(self, student, columns=None, term=None):
+        """One row per run that scored `student`, oldest first."""
+        columns = list(dict.fromkeys(['run', 'term', 'class'] + (columns or TRAJECTORY_COLUMNS)))
+        return self.read(columns, term=term, students=[student]).sort_values('run', ignore_index=True)
+
+    def compare_runs(self, from_run, to_run, column='ai_risk_level', classes=None):
+        """Students scored in both runs with their `column` value in each ('from', 'to')."""
+        frame = self.read(['run', 'student', column], classes=classes, runs=[from_run, to_run])
+        levels = LEVEL_ORDER.get(column)
+        def side(run_id):
+            values = frame[frame['run'] == run_id].drop_duplicates('student', keep='last').set_index('student')[column]
+            return values.astype(pd.CategoricalDtype(levels, ordered=True)) if levels else values
+        pairs = pd.concat({'from': side(from_run), 'to': side(to_run)}, axis=1, join='inner')
+        return pairs.rename_axis('student').reset_index()
+
+    def transition_matrix(self, from_run, to_run, column='ai_risk_level', classes=None):
+        return transition_counts(self.compare_runs(from_run, to_run, column, classes))
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_history_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = HistoryStore()
+        return _store
@@ -0,0 +1,188 @@
+# utils/instrumentation.py
+
+"""
+Per-stage timings for one pipeline run. Wrap work in `stage(...)` or decorate a function with
+`instrumented(...)`; records go to the run started with `start_run(...)` in the current context and
+are aggregated per stage (calls, rows, seconds, optional tracemalloc peak). Outside a run, or with
+INSTRUMENTATION['ENABLED'] off, both are a single context-variable lookup.
+"""
+
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from config import INSTRUMENTATION
+
+@dataclass
+class StageStats:
+    stage: str
+    calls: int = 0
+    rows: int = 0
+    seconds: float = 0.0
+    peak_bytes: int = None
+
+class Run:
+    """The stage breakdown of one run, e.g. one "Predict Risk" click or one CLI command."""
+    def __init__(self, name, trace_memory=None):
+        self.name = name
+        self.run_id = uuid.uuid4().hex[:12]
+        self.started_at = time.time()
+        self.seconds = None
+        self.trace_memory = INSTRUMENTATION['TRACE_MEMORY'] if trace_memory is None else trace_memory
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds, rows=None, peak_bytes=None):
+        with self._lock:
+            stats = self.stages.get(stage)
+            if stats is None:
+                stats = self.stages[stage] = StageStats(stage)
+            stats.calls += 1
+            stats.seconds += seconds
+            stats.rows += rows or 0
+            if peak_bytes is not None:
+                stats.peak_bytes = max(stats.peak_bytes or 0, peak_bytes)
+
+    def rows(self):
+        """One dict per stage in the order stages first ran."""
+        with self._lock:
+            return [asdict(stats) for stats in self.stages.values()]
+
+    def to_jsonl(self):
+        base = {'run_id': self.run_id, 'run': self.name, 'started_at': self.started_at, 'run_seconds': self.seconds}
+        return "".join(json.dumps({**base, **row}) + "\n" for row in self.rows())
+
+    def to_prometheus(self, prefix='student_dashboard'):
+        """Prometheus text exposition format, e.g. for node_exporter's textfile collector."""
+        lines = []
+        metrics = [('stage_seconds', 'seconds', 'Wall time spent in the stage during the last run.'),
+                   ('stage_calls', 'calls', 'Times the stage ran during the last run.'),
+                   ('stage_rows', 'rows', 'Rows processed by the stage during the last run.'),
+                   ('stage_peak_bytes', 'peak_bytes', 'Peak traced allocation while the stage ran.')]
+        rows = self.rows()
+        for metric, field, help_text in metrics:
+            samples = [(row['stage'], row[field]) for row in rows if row[field] is not None]
+            if not samples:
+                continue
+            lines += [f"# HELP {prefix}_{metric} {help_text}", f"# TYPE {prefix}_{metric} gauge"]
+            lines += [f'{prefix}_{metric}{{run="{self.name}",stage="{stage}"}} {value}' for stage, value in samples]
+        if self.seconds is not None:
+            lines += [f"# TYPE {prefix}_run_seconds gauge", f'{prefix}_run_seconds{{run="{self.name}"}} {self.seconds}']
+        return "\n".join(lines) + "\n"
+
+_current_run = contextvars.ContextVar('instrumentation_run', default=None)
+_current_frames = contextvars.ContextVar('instrumentation_frames', default=())
+
+class _Frame:
+    __slots__ = ('rows', 'start_memory', 'peak')
+
+    def __init__(self, rows=None):
+        self.rows = rows
+        self.start_memory = 0
+        self.peak = 0
+
+class _NullFrame:
+    """Returned when nothing is being recorded; setting rows on it does nothing."""
+    rows = None
+
+    def __setattr__(self, name, value):
+        pass
+
+_NULL_FRAME = _NullFrame()
+
+def current_run():
+    return _current_run.get()
+
+@contextmanager
+def start_run(name, trace_memory=None, export=True):
+    """Collects every stage timed in this context (and contexts copied from it) into a new Run."""
+    run = Run(name, trace_memory) if INSTRUMENTATION['ENABLED'] else None
+    if run is None:
+        yield None
+        return
+    started_tracing = run.trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    token = _current_run.set(run)
+    start = time.perf_counter()
+    try:
+        yield run
+    finally:
+        run.seconds = time.perf_counter() - start
+        _current_run.reset(token)
+        if started_tracing:
+            tracemalloc.stop()
+        if export:
+            export_run(run)
+
+@contextmanager
+def stage(name, rows=None):
+    """Times the enclosed block as `name`; set `.rows` on the yielded frame if the count is known only later."""
+    run = _current_run.get()
+    if run is None:
+        yield _NULL_FRAME
+        return
+    frame = _Frame(rows)
+    parents = _current_frames.get()
+    tracing = run.trace_memory and tracemalloc.is_tracing()
+    if tracing:
+        current, peak = tracemalloc.get_traced_memory()
+        if parents:
+            # reset_peak() below would lose the parent's peak so far; carry it over first.
+            parents[-1].peak = max(parents[-1].peak, peak)
+        tracemalloc.reset_peak()
+        frame.start_memory = current
+    token = _current_frames.set(parents + (frame,))
+    start = time.perf_counter()
+    try:
+        yield frame
+    finally:
+        seconds = time.perf_counter() - start
+        _current_frames.reset(token)
+        peak_bytes = None
+        if tracing:
+            frame.peak = max(frame.peak, tracemalloc.get_traced_memory()[1])
+            peak_bytes = max(frame.peak - frame.start_memory, 0)
+            if parents:
+                parents[-1].peak = max(parents[-1].peak, frame.peak)
+        run.record(name, seconds, frame.rows, peak_bytes)
+
+def instrumented(name, rows=None):
+    """
+    Decorator form of `stage`. `rows` maps the function's result to a row count,
+    e.g. `rows=len` for functions returning a DataFrame.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _current_run.get() is None:
+                return func(*args, **kwargs)
+            with stage(name) as frame:
+                result = func(*args, **kwargs)
+                if rows is not None and result is not None:
+                    frame.rows = rows(result)
+                return result
+        return wrapper
+    return decorator
+
+def _write_atomic(path, text):
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+def export_run(run, jsonl_path=None, prometheus_path=None):
+    """Appends the run to the JSON-lines log and rewrites the Prometheus file, for whichever paths are configured."""
+    jsonl_path = jsonl_path or INSTRUMENTATION['JSONL_PATH']
+    prometheus_path = prometheus_path or INSTRUMENTATION['PROMETHEUS_PATH']
+    if jsonl_path:
+        with open(jsonl_path, 'a') as f:
+            f.write(run.to_jsonl())
+    if prometheus_path:
+        _write_atomic(prometheus_path, run.to_prometheus())
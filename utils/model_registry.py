@@ -0,0 +1,192 @@
+# utils/model_registry.py
+
+import io
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, asdict, field
+import joblib
+import numpy as np
+from config import MODEL_REGISTRY
+from utils.predictions import MODEL_FEATURES, get_scorer, valid_risk_bands, calibrate_model
+
+@dataclass
+class ModelInfo:
+    sha256: str
+    model_type: str
+    feature_names: list
+    n_features: int
+    classes: list
+    size_bytes: int
+    linear_fast_path: bool
+    risk_band_cuts: list = field(default=None)
+
+def describe_model(model, sha256, size_bytes):
+    """Metadata scoring needs before it runs: what the model is and which features it expects."""
+    n_features = getattr(model, 'n_features_in_', None)
+    names = getattr(model, 'feature_names_in_', None)
+    if names is not None:
+        feature_names = [str(n) for n in names]
+    elif n_features in (None, len(MODEL_FEATURES)):
+        feature_names = list(MODEL_FEATURES)
+    else:
+        feature_names = None
+    classes = getattr(model, 'classes_', None)
+    cuts = getattr(model, 'risk_band_cuts_', None)
+    cuts = cuts if valid_risk_bands(cuts) else None
+    return ModelInfo(
+        sha256=sha256,
+        model_type=f"{type(model).__module__}.{type(model).__name__}",
+        feature_names=feature_names,
+        n_features=int(n_features) if n_features is not None else len(feature_names or []),
+        classes=[c.item() if hasattr(c, 'item') else c for c in classes] if classes is not None else None,
+        size_bytes=size_bytes,
+        linear_fast_path=get_scorer(model) is not None,
+        risk_band_cuts=[float(c) for c in cuts] if cuts is not None else None,
+    )
+
+def check_compatibility(info, columns):
+    """Problems that would stop this model from scoring a frame with `columns`; empty if it can run."""
+    if info.feature_names is None:
+        return [f"Model expects {info.n_features} unnamed features; this dashboard supplies {len(MODEL_FEATURES)}."]
+    available = (set(columns) | {'gender_encoded'}) if 'gender' in columns else set(columns)
+    missing = [f for f in info.feature_names if f not in available]
+    problems = [f"Missing column '{f}' required by the model" for f in missing]
+    if not missing and list(info.feature_names) != list(MODEL_FEATURES):
+        problems.append(f"Model was trained on features {info.feature_names}, expected {MODEL_FEATURES}.")
+    return problems
+
+class ModelRegistry:
+    """
+    Models keyed by the SHA-256 of their file bytes. Deserialized models live in an LRU cache
+    bounded by MAX_CACHE_BYTES (file size as the cost); every accepted model is also written to
+    STORE_DIR so later processes can load it with joblib's mmap_mode instead of unpickling uploads.
+    """
+    def __init__(self, store_dir=None, max_cache_bytes=None):
+        self.store_dir = store_dir or MODEL_REGISTRY['STORE_DIR']
+        self.max_cache_bytes = max_cache_bytes or MODEL_REGISTRY['MAX_CACHE_BYTES']
+        self._cache = OrderedDict()  # sha256 -> (model, info)
+        self._cached_bytes = 0
+        self._lock = threading.RLock()
+
+    def _paths(self, sha256):
+        base = os.path.join(self.store_dir, sha256)
+        return base + '.joblib', base + '.json'
+
+    def _remember(self, model, info):
+        with self._lock:
+            if info.sha256 in self._cache:
+                self._cache.move_to_end(info.sha256)
+                return
+            self._cache[info.sha256] = (model, info)
+            self._cached_bytes += info.size_bytes
+            while self._cached_bytes > self.max_cache_bytes and len(self._cache) > 1:
+                _, (_, evicted) = self._cache.popitem(last=False)
+                self._cached_bytes -= evicted.size_bytes
+
+    def _write_info(self, info):
+        _, info_path = self._paths(info.sha256)
+        tmp = info_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(asdict(info), f, indent=2)
+        os.replace(tmp, info_path)
+
+    def _persist(self, model, info):
+        os.makedirs(self.store_dir, exist_ok=True)
+        model_path, _ = self._paths(info.sha256)
+        if not os.path.exists(model_path):
+            tmp = model_path + '.tmp'
+            joblib.dump(model, tmp)  # uncompressed, so numpy arrays can be memory-mapped on load
+            os.replace(tmp, model_path)
+        self._write_info(info)
+
+    def _load_stored(self, sha256):
+        model_path, info_path = self._paths(sha256)
+        if not (os.path.exists(model_path) and os.path.exists(info_path)):
+            return None
+        model = joblib.load(model_path, mmap_mode='r')
+        with open(info_path) as f:
+            info = ModelInfo(**json.load(f))
+        if valid_risk_bands(info.risk_band_cuts):
+            model.risk_band_cuts_ = np.asarray(info.risk_band_cuts, dtype=np.float64)
+        else:
+            info.risk_band_cuts = None  # e.g. written by an older version from a degenerate batch
+        get_scorer(model)
+        return model, info
+
+    def get(self, sha256):
+        """(model, info) for a known hash from memory or the local store, else None."""
+        with self._lock:
+            if sha256 in self._cache:
+                self._cache.move_to_end(sha256)
+                return self._cache[sha256]
+        loaded = self._load_stored(sha256)
+        if loaded is not None:
+            self._remember(*loaded)
+        return loaded
+
+    def load_bytes(self, data):
+        """(model, info) for a model file's bytes; only unpickles bytes the registry has never seen."""
+        sha256 = hashlib.sha256(data).hexdigest()
+        found = self.get(sha256)
+        if found is not None:
+            return found
+        model = joblib.load(io.BytesIO(data))
+        info = describe_model(model, sha256, len(data))
+        self._persist(model, info)
+        self._remember(model, info)
+        return model, info
+
+    def save_risk_bands(self, info, cuts):
+        """Records calibrated cut-points in the stored metadata and the cached model/ModelInfo; invalid cut-points raise ValueError."""
+        if not valid_risk_bands(cuts):
+            raise ValueError(f"Refusing to store invalid risk band cut-points {[float(c) for c in cuts]}")
+        info.risk_band_cuts = [float(c) for c in cuts]
+        with self._lock:
+            cached = self._cache.get(info.sha256)
+            if cached is not None:  # keep the in-memory model and its ModelInfo in step with the store
+                cached[0].risk_band_cuts_ = np.asarray(info.risk_band_cuts, dtype=np.float64)
+                cached[1].risk_band_cuts = info.risk_band_cuts
+        if os.path.exists(self._paths(info.sha256)[1]):
+            self._write_info(info)
+
+    def calibrate(self, model, info, probabilities, method=None):
+        """Fits the model's risk band cut-points on a reference batch and stores them with it; ValueError if it cannot."""
+        cuts = calibrate_model(model, probabilities, method)
+        self.save_risk_bands(info, cuts)
+        return cuts
+
+    def stored_hashes(self):
+        if not os.path.isdir(self.store_dir):
+            return []
+        return [name[:-len('.json')] for name in os.listdir(self.store_dir) if name.endswith('.json')]
+
+    def warm_load(self):
+        """Memory-maps every stored model into the cache, most recently stored first, until the cap is hit."""
+        hashes = sorted(self.stored_hashes(), key=lambda h: os.path.getmtime(self._paths(h)[1]), reverse=True)
+        for sha256 in hashes:
+            if self._cached_bytes >= self.max_cache_bytes:
+                break
+            try:
+                self.get(sha256)
+            except Exception:
+                continue  # an unreadable store entry should not stop the app from starting
+
+    def infos(self):
+        with self._lock:
+            return [info for _, info in self._cache.values()]
+
+_registry = None
+_registry_lock = threading.Lock()
+
+def get_model_registry():
+    """The process-wide registry, warm-loaded from the local store on first use."""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ModelRegistry()
+            if MODEL_REGISTRY['WARM_LOAD']:
+                _registry.warm_load()
+        return _registry
@@ -0,0 +1,259 @@
+# utils/outbox.py
+
+import asyncio
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import date
+from config import EMAIL_SETTINGS, OUTBOX
+from utils.email_sender import RateLimiter, SMTPSession, build_report_message, is_transient_smtp_error
+from utils.runtime import logger
+from utils.instrumentation import instrumented, start_run
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY,
+    student_key TEXT NOT NULL,
+    report_type TEXT NOT NULL,
+    term TEXT NOT NULL,
+    student_name TEXT,
+    recipient_email TEXT NOT NULL,
+    subject TEXT,
+    body TEXT,
+    pdf BLOB,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    claim TEXT,
+    next_attempt_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    sent_at REAL,
+    UNIQUE (student_key, report_type, term)
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at);
+"""
+STATUSES = ['queued', 'sending', 'sent', 'failed']
+
+def current_term(today=None):
+    """OUTBOX['TERM'] when set, otherwise the calendar half-year, e.g. '2026-H2'."""
+    if OUTBOX['TERM']:
+        return OUTBOX['TERM']
+    today = today or date.today()
+    return f"{today.year}-H{1 if today.month <= 6 else 2}"
+
+def student_key(student_name, recipient_email):
+    """Identity used for idempotency: the same student and address never get one report type twice a term."""
+    return f"{str(student_name).strip().lower()} <{str(recipient_email).strip().lower()}>"
+
+class Outbox:
+    """
+    Report emails persisted in SQLite until delivered. Rows move queued -> sending -> sent, or back
+    to queued with a later next_attempt_at after a transient failure, or to failed. A failed row is
+    the only one that enqueueing the same (student, report type, term) again will replace.
+    """
+    def __init__(self, path=None, settings=None):
+        self.path = path or OUTBOX['DB_PATH']
+        self.settings = {**OUTBOX, **(settings or {})}
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+        self._worker = None
+        self._worker_lock = threading.Lock()
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            with db:  # commit on success, roll back on error
+                yield db
+        finally:
+            db.close()
+
+    @instrumented('outbox_enqueue', rows=int)
+    def enqueue(self, job, term=None):
+        """Stores an EmailJob for delivery. False when it is already queued or sent for this term."""
+        now = time.time()
+        key = student_key(job.student_name, job.recipient_email)
+        with self._connect() as db:
+            cursor = db.execute("""
+                INSERT INTO outbox (student_key, report_type, term, student_name, recipient_email, subject, body, pdf,
+                                    next_attempt_at, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (student_key, report_type, term) DO UPDATE SET
+                    recipient_email = excluded.recipient_email, subject = excluded.subject, body = excluded.body,
+                    pdf = excluded.pdf, status = 'queued', attempts = 0, last_error = NULL, claim = NULL,
+                    next_attempt_at = excluded.next_attempt_at, updated_at = excluded.updated_at
+                WHERE outbox.status = 'failed'
+            """, (key, job.report_type, term or current_term(), job.student_name, job.recipient_email,
+                  job.subject, job.body, job.pdf_data, now, now, now))
+        return cursor.rowcount == 1
+
+    def handled_keys(self, report_type, term=None):
+        """Student keys already queued, in flight or sent for this report type and term."""
+        with self._connect() as db:
+            rows = db.execute("SELECT student_key FROM outbox WHERE report_type = ? AND term = ? AND status != 'failed'",
+                              (report_type, term or current_term())).fetchall()
+        return {key for key, in rows}
+
+    def claim(self, limit):
+        """Marks up to `limit` due rows as sending and returns them; safe against concurrent workers."""
+        token, now = uuid.uuid4().hex, time.time()
+        with self._connect() as db:
+            db.execute("""
+                UPDATE outbox SET status = 'sending', claim = ?, updated_at = ?
+                WHERE id IN (SELECT id FROM outbox WHERE status = 'queued' AND next_attempt_at <= ? ORDER BY id LIMIT ?)
+            """, (token, now, now, limit))
+            db.row_factory = sqlite3.Row
+            return db.execute("SELECT * FROM outbox WHERE claim = ? ORDER BY id", (token,)).fetchall()
+
+    def recover_stale(self):
+        """Requeues rows left in 'sending' by a worker that died (delivery is at-least-once)."""
+        with self._connect() as db:
+            db.execute("UPDATE outbox SET status = 'queued', claim = NULL WHERE status = 'sending' AND updated_at < ?",
+                       (time.time() - self.settings['STALE_SENDING_SECONDS'],))
+
+    def mark_sent(self, row_id):
+        now = time.time()
+        keep_pdf = "pdf" if self.settings['KEEP_SENT_PDFS'] else "NULL"
+        with self._connect() as db:
+            db.execute(f"UPDATE outbox SET status = 'sent', pdf = {keep_pdf}, attempts = attempts + 1, last_error = NULL, "
+                       "sent_at = ?, updated_at = ? WHERE id = ?", (now, now, row_id))
+
+    def mark_failed(self, row_id, error, attempts):
+        """Schedules a retry with exponential backoff, or gives up at MAX_ATTEMPTS; `attempts` None marks a permanent failure."""
+        now = time.time()
+        retry = attempts is not None and attempts < self.settings['MAX_ATTEMPTS']
+        delay = min(self.settings['RETRY_BASE_SECONDS'] * 2 ** ((attempts or 1) - 1), self.settings['RETRY_MAX_SECONDS'])
+        with self._connect() as db:
+            db.execute("UPDATE outbox SET status = ?, attempts = attempts + 1, last_error = ?, claim = NULL, "
+                       "next_attempt_at = ?, updated_at = ? WHERE id = ?",
+                       ('queued' if retry else 'failed', error, now + delay, now, row_id))
+
+    def next_due(self):
+        """When the earliest queued row becomes due, or None when nothing is queued."""
+        with self._connect() as db:
+            return db.execute("SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'queued'").fetchone()[0]
+
+    def has_pending(self):
+        with self._connect() as db:
+            return db.execute("SELECT 1 FROM outbox WHERE status IN ('queued', 'sending') LIMIT 1").fetchone() is not None
+
+    def progress(self, report_type=None, term=None):
+        """Counts per status plus the failed rows (name, email, error), optionally for one report type and term."""
+        where, params = [], []
+        if report_type:
+            where.append("report_type = ?"); params.append(report_type)
+        if term:
+            where.append("term = ?"); params.append(term)
+        clause = f"WHERE {' AND '.join(where)}" if where else ""
+        with self._connect() as db:
+            counts = dict(db.execute(f"SELECT status, COUNT(*) FROM outbox {clause} GROUP BY status", params).fetchall())
+            failed = db.execute(f"SELECT student_name, recipient_email, last_error FROM outbox {clause} "
+                                f"{'AND' if where else 'WHERE'} status = 'failed' ORDER BY id", params).fetchall()
+        counts = {status: counts.get(status, 0) for status in STATUSES}
+        counts['total'] = sum(counts.values())
+        return counts, failed
+
+    def start_worker(self, sender_email, sender_password, email_settings=None):
+        """Starts the background delivery worker unless one is running; a running worker is told to look again."""
+        with self._worker_lock:
+            if self._worker is not None and not self._worker.finished:
+                self._worker.wake = True
+                return self._worker
+            self._worker = DeliveryWorker(self, sender_email, sender_password, email_settings)
+            self._worker.start()
+            return self._worker
+
+    def worker_running(self):
+        return self._worker is not None and not self._worker.finished
+
+class DeliveryWorker(threading.Thread):
+    """
+    Drains the outbox on its own asyncio loop: one coroutine per pooled SMTP session, with the
+    blocking smtplib calls pushed to threads. Exits once nothing is queued.
+    """
+    def __init__(self, outbox, sender_email, sender_password, email_settings=None):
+        super().__init__(name="outbox-worker", daemon=True)
+        self.outbox = outbox
+        self.sender_email = sender_email
+        self.sender_password = sender_password
+        self.settings = {**EMAIL_SETTINGS, **(email_settings or {})}
+        self.wake = False
+        self.finished = False
+
+    def run(self):
+        try:
+            with start_run('outbox_delivery'):
+                asyncio.run(self._run())
+        except Exception:
+            logger.exception("Outbox worker stopped")
+        finally:
+            self.finished = True
+
+    async def _deliver(self, session, limiter, row):
+        msg = build_report_message(self.sender_email, row['recipient_email'], row['subject'], row['body'],
+                                   row['pdf'], row['student_name'], row['report_type'])
+        try:
+            await asyncio.to_thread(limiter.acquire)
+            await asyncio.to_thread(session.send, msg)
+        except Exception as e:
+            await asyncio.to_thread(session.close)
+            attempts = row['attempts'] + 1 if is_transient_smtp_error(e) else None
+            await asyncio.to_thread(self.outbox.mark_failed, row['id'], str(e) or type(e).__name__, attempts)
+        else:
+            await asyncio.to_thread(self.outbox.mark_sent, row['id'])
+
+    async def _consume(self, rows, session, limiter):
+        while True:
+            row = await rows.get()
+            try:
+                await self._deliver(session, limiter, row)
+            except Exception:
+                logger.exception("Outbox delivery of row %s failed", row['id'])
+            finally:
+                rows.task_done()
+
+    async def _run(self):
+        outbox = self.outbox
+        await asyncio.to_thread(outbox.recover_stale)
+        pool_size = max(1, int(self.settings['POOL_SIZE']))
+        limiter = RateLimiter(self.settings['GLOBAL_RATE'])
+        sessions = [SMTPSession(self.sender_email, self.sender_password, self.settings) for _ in range(pool_size)]
+        rows = asyncio.Queue(maxsize=pool_size * 2)
+        consumers = [asyncio.create_task(self._consume(rows, session, limiter)) for session in sessions]
+        try:
+            while True:
+                claimed = await asyncio.to_thread(outbox.claim, pool_size)
+                for row in claimed:
+                    await rows.put(row)
+                if claimed:
+                    continue
+                await rows.join()  # in-flight rows may have been requeued for a retry
+                due = await asyncio.to_thread(outbox.next_due)
+                if due is None:
+                    with outbox._worker_lock:
+                        if not self.wake:
+                            self.finished = True
+                            break
+                        self.wake = False
+                    continue
+                await asyncio.sleep(min(max(due - time.time(), 0.05), outbox.settings['POLL_SECONDS']))
+        finally:
+            for task in consumers:
+                task.cancel()
+            await asyncio.gather(*consumers, return_exceptions=True)
+            for session in sessions:
+                session.close()
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+def get_outbox():
+    global _outbox
+    with _outbox_lock:
+        if _outbox is None:
+            _outbox = Outbox()
+        return _outbox
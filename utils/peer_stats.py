@@ -0,0 +1,43 @@
+# utils/peer_stats.py
+
+from config import PEER_STATS
+from utils.instrumentation import instrumented
+
+@instrumented('peer_stats')
+def compute_peer_stats(df, group_columns=None, metrics=None, percentiles=None):
+    """
+    Aggregates peer-group statistics with one groupby per grouping column.
+    Returns {group_column: {group value: {statistic: {metric: value}}}}, where statistic is
+    'mean', 'count' or a percentile such as 'p25', so lookups while reporting are plain dict reads.
+    """
+    group_columns = group_columns or PEER_STATS['GROUP_COLUMNS']
+    metrics = [m for m in (metrics or PEER_STATS['METRICS']) if m in df.columns]
+    percentiles = PEER_STATS['PERCENTILES'] if percentiles is None else percentiles
+    peer_stats = {}
+    for column in group_columns:
+        if column not in df.columns:
+            continue
+        grouped = df.groupby(column, observed=True)[metrics]
+        tables = {'mean': grouped.mean(), 'count': grouped.count()}
+        for p in percentiles:
+            tables[f'p{round(p * 100)}'] = grouped.quantile(p)
+        peer_stats[column] = {
+            group: {stat: table.loc[group].to_dict() for stat, table in tables.items()}
+            for group in tables['mean'].index
+        }
+    return peer_stats
+
+def group_metrics(group_stats, group_value, statistic='mean'):
+    """
+    {metric: value} for one group of a single column's statistics. A group with no statistics (e.g. a
+    student whose level is NaN) gets NaN for every metric, as an empty peer group always did.
+    """
+    stats = group_stats.get(group_value)
+    if stats is not None:
+        return stats[statistic]
+    metrics = next(iter(group_stats.values()), {}).get(statistic) or PEER_STATS['METRICS']
+    return dict.fromkeys(metrics, float('nan'))
+
+def get_peer_metrics(peer_stats, group_column, group_value, statistic='mean'):
+    """Returns {metric: value} for one peer group, e.g. the averages the report charts compare against."""
+    return group_metrics(peer_stats.get(group_column, {}), group_value, statistic)
@@ -0,0 +1,47 @@
+# utils/pipeline.py
+
+import numpy as np
+import pandas as pd
+from utils.predictions import get_ml_predictions, assign_risk_levels, get_risk_bands, encode_gender, MODEL_INPUT_COLUMNS
+from utils.expert_system import generate_dropout_report, get_default_ruleset
+from utils.runtime import report_error, stop
+from utils.instrumentation import instrumented, stage
+
+@instrumented('score_cohort', rows=len)
+def score_cohort(model, data, cache=None, model_key=None):
+    """
+    Runs the AI model and the expert system over merged student data and returns one combined frame.
+    Risk bands use the model's calibrated cut-points; an uncalibrated model is banded on this batch alone.
+    With a ScoringCache (and `model_key`, e.g. the model's SHA-256), only rows whose inputs changed
+    since an earlier run are scored; the rest reuse the cached probability and expert outcome.
+    """
+    if cache is None:
+        df_ml = get_ml_predictions(model, data)
+        df_expert = generate_dropout_report(data)
+    else:
+        df_ml, df_expert = _score_incremental(model, data, cache, model_key)
+    probabilities = df_ml['dropout_probability']
+    df_ml['ai_risk_level'] = assign_risk_levels(probabilities, get_risk_bands(model, probabilities))
+    return pd.concat([df_ml, df_expert], axis=1)
+
+def _score_incremental(model, data, cache, model_key):
+    ruleset = get_default_ruleset()
+    for col in MODEL_INPUT_COLUMNS + ruleset.required_columns:
+        if col not in data.columns: report_error(f"Error: Missing column '{col}'"); stop()
+    columns = list(dict.fromkeys(MODEL_INPUT_COLUMNS + ruleset.input_columns))
+    with stage('scoring_cache_lookup', rows=len(data)):
+        keys = cache.row_keys(data, columns, model_key or id(model), ruleset.fingerprint)
+        found, probabilities, rule_index = cache.lookup(keys)
+    missing = np.flatnonzero(~found)
+    if missing.size:
+        changed = data.iloc[missing]
+        new_probabilities = get_ml_predictions(model, changed)['dropout_probability'].to_numpy()
+        with stage('rule_engine', rows=len(changed)):
+            new_rule_index, _ = ruleset.rule_indices(changed)
+        probabilities[missing], rule_index[missing] = new_probabilities, new_rule_index
+        cache.store(keys[missing], new_probabilities, new_rule_index)
+
+    df_ml = data.copy(deep=False)
+    df_ml['gender_encoded'] = encode_gender(df_ml['gender'])
+    df_ml['dropout_probability'] = probabilities
+    return df_ml, ruleset.outcomes(rule_index, data.index)
@@ -1,24 +1,240 @@
 # utils/predictions.py
 
+import weakref
+import numpy as np
 import pandas as pd
-import streamlit as st
-from sklearn.cluster import KMeans
-
-def get_ml_predictions(model, data):
-    df = data.copy()
-    df['gender_encoded'] = df['gender'].apply(lambda x: 1 if x.lower() == 'male' else 0)
-    features = ['attendance', 'current_test_score', 'current_assignment_score', 'previous_test_score', 'previous_assignment_score', 'fees', 'gender_encoded']
-    for col in features:
-        if col not in df.columns: st.error(f"Error: Missing column '{col}'"); st.stop()
-    X = df[features]
-    df['dropout_probability'] = model.predict_proba(X)[:, 1]
+from config import RISK_BANDS, INFERENCE
+from utils.runtime import report_error, report_warning, stop
+from utils.instrumentation import instrumented
+
+MODEL_FEATURES = ['attendance', 'current_test_score', 'current_assignment_score', 'previous_test_score', 'previous_assignment_score', 'fees', 'gender_encoded']
+MODEL_INPUT_COLUMNS = MODEL_FEATURES[:-1] + ['gender']  # raw columns the features are built from
+
+def encode_gender(gender):
+    """1 for 'male' (any case), else 0, without a per-row Python call."""
+    if isinstance(gender.dtype, pd.CategoricalDtype):
+        is_male = np.asarray(gender.cat.categories.astype(str).str.lower() == 'male')
+        codes = gender.cat.codes.to_numpy()
+        return np.where(codes >= 0, is_male[codes], False).astype(np.int8)
+    return gender.astype(str).str.lower().eq('male').to_numpy().astype(np.int8)
+
+def _sigmoid(z):
+    return 0.5 * (1.0 + np.tanh(0.5 * z))
+
+class LinearScorer:
+    """
+    A fitted linear classifier reduced to its coefficients. predict_proba is one dot product plus
+    the model's link: sigmoid (binary), normalised one-vs-rest sigmoids, or softmax (multinomial).
+    """
+    LINKS = ('binary', 'ovr', 'multinomial')
+
+    def __init__(self, coef, intercept, link, dtype=None):
+        self.dtype = np.dtype(dtype or INFERENCE['DTYPE'])
+        self.coef_t = np.ascontiguousarray(np.asarray(coef, dtype=self.dtype).T)
+        self.intercept = np.asarray(intercept, dtype=self.dtype)
+        self.link = link
+
+    def predict_proba(self, X):
+        z = X @ self.coef_t + self.intercept
+        if self.link == 'binary':
+            p = _sigmoid(z[:, 0])
+            return np.column_stack([1.0 - p, p])
+        if self.link == 'ovr':
+            p = _sigmoid(z)
+            return p / p.sum(axis=1, keepdims=True)
+        z -= z.max(axis=1, keepdims=True)
+        p = np.exp(z)
+        return p / p.sum(axis=1, keepdims=True)
+
+    def predict_column(self, columns, column=1, chunk_size=None):
+        """Probability of class index `column` for feature arrays `columns`, scored in contiguous chunks."""
+        chunk_size = chunk_size or INFERENCE['CHUNK_SIZE']
+        n = len(columns[0])
+        out = np.empty(n, dtype=np.float64)
+        X = np.empty((min(chunk_size, n), len(columns)), dtype=self.dtype)
+        for start in range(0, n, chunk_size):
+            stop_ = min(start + chunk_size, n)
+            block = X[:stop_ - start]
+            for j, values in enumerate(columns):
+                block[:, j] = values[start:stop_]
+            out[start:stop_] = self.predict_proba(block)[:, column]
+        return out
+
+def build_linear_scorer(model, dtype=None):
+    """
+    A LinearScorer reproducing `model.predict_proba`, or None if the model is not a plain linear
+    classifier. The link is picked by checking each candidate against predict_proba on a fixed probe.
+    """
+    coef, intercept = getattr(model, 'coef_', None), getattr(model, 'intercept_', None)
+    if coef is None or intercept is None or not hasattr(model, 'predict_proba'):
+        return None
+    coef = np.atleast_2d(np.asarray(coef, dtype=np.float64))
+    intercept = np.atleast_1d(np.asarray(intercept, dtype=np.float64))
+    if coef.shape[0] != intercept.shape[0]:
+        return None
+    probe = np.random.default_rng(0).normal(50, 30, size=(32, coef.shape[1]))
+    feature_names = getattr(model, 'feature_names_in_', None)
+    try:
+        expected = model.predict_proba(pd.DataFrame(probe, columns=feature_names) if feature_names is not None else probe)
+    except Exception:
+        return None
+    for link in (['binary'] if coef.shape[0] == 1 else ['multinomial', 'ovr']):
+        candidate = LinearScorer(coef, intercept, link, np.float64)
+        if np.allclose(candidate.predict_proba(probe), expected, rtol=1e-7, atol=1e-9):
+            return LinearScorer(coef, intercept, link, dtype)
+    return None
+
+_scorers = weakref.WeakKeyDictionary()
+
+def get_scorer(model):
+    """The cached LinearScorer for `model` (built on first use), or None to use sklearn."""
+    try:
+        if model not in _scorers:
+            _scorers[model] = build_linear_scorer(model)
+        return _scorers[model]
+    except TypeError:  # not weak-referenceable or hashable
+        return build_linear_scorer(model)
+
+@instrumented('model_inference', rows=len)
+def get_ml_predictions(model, data, backend=None):
+    backend = backend or INFERENCE['BACKEND']
+    for col in MODEL_INPUT_COLUMNS:
+        if col not in data.columns: report_error(f"Error: Missing column '{col}'"); stop()
+    df = data.copy(deep=False)
+    df['gender_encoded'] = encode_gender(df['gender'])
+    scorer = get_scorer(model) if backend != 'sklearn' else None
+    if scorer is not None:
+        columns = [df[col].to_numpy(dtype=scorer.dtype, na_value=np.nan) for col in MODEL_FEATURES]
+        df['dropout_probability'] = scorer.predict_column(columns)
+    elif backend == 'numpy':
+        report_error("Error: This model is not a linear classifier and cannot use the NumPy backend."); stop()
+    else:
+        df['dropout_probability'] = model.predict_proba(df[MODEL_FEATURES])[:, 1]
     return df
 
-def assign_risk_levels(probabilities):
-    if probabilities.empty: return pd.Series()
-    kmeans = KMeans(n_clusters=3, random_state=42, n_init='auto')
-    clusters = kmeans.fit_predict(probabilities.values.reshape(-1, 1))
-    df_temp = pd.DataFrame({'probability': probabilities, 'cluster': clusters})
-    cluster_means = df_temp.groupby('cluster')['probability'].mean().sort_values()
-    risk_mapping = {cluster_means.index[2]: 'Low', cluster_means.index[1]: 'Medium', cluster_means.index[0]: 'High'}
-    return df_temp['cluster'].map(risk_mapping)
\ No newline at end of file
+# Bands in ascending order of dropout_probability, matching the original cluster-to-label mapping.
+RISK_LABELS = ['High', 'Medium', 'Low']
+
+def _weighted_distinct(values, max_distinct):
+    """Sorted distinct values with their counts; above `max_distinct` values are pooled into equal-width bins."""
+    if values.size and values[-1] > values[0]:
+        distinct, counts = np.unique(values, return_counts=True)
+        if distinct.size <= max_distinct:
+            return distinct, counts.astype(np.float64)
+        bins = ((values - values[0]) / (values[-1] - values[0]) * (max_distinct - 1)).astype(np.int64)
+        counts = np.bincount(bins, minlength=max_distinct).astype(np.float64)
+        sums = np.bincount(bins, weights=values, minlength=max_distinct)
+        keep = counts > 0
+        return sums[keep] / counts[keep], counts[keep]
+    return values[:1], np.array([float(values.size)])
+
+def jenks_breaks(values, n_classes, max_distinct=None):
+    """
+    Cut-points of the optimal 1-D partition into `n_classes` groups (minimum within-group sum of
+    squares, i.e. exact 1-D k-means), by dynamic programming over the sorted distinct values.
+    Each layer is filled by divide and conquer on the monotone split point, so cost is O(k m log m).
+    Returns n_classes - 1 ascending cut-points (midpoints between neighbouring groups), padded with
+    +inf when there are fewer distinct values than classes.
+    """
+    max_distinct = max_distinct or RISK_BANDS['MAX_DISTINCT_VALUES']
+    values = np.sort(np.asarray(values, dtype=np.float64))
+    values = values[~np.isnan(values)]
+    v, w = _weighted_distinct(values, max_distinct)
+    m, k = v.size, min(n_classes, v.size)
+    W = np.concatenate([[0.0], np.cumsum(w)])
+    S = np.concatenate([[0.0], np.cumsum(w * v)])
+    Q = np.concatenate([[0.0], np.cumsum(w * v * v)])
+
+    def cost(starts, end):
+        n = W[end + 1] - W[starts]; total = S[end + 1] - S[starts]
+        return (Q[end + 1] - Q[starts]) - total * total / n
+
+    prev = cost(np.zeros(m, dtype=np.int64), np.arange(m)) if m else np.zeros(0)
+    split_points = []
+    for layer in range(1, k):
+        cur = np.full(m, np.inf); arg = np.zeros(m, dtype=np.int64)
+        stack = [(layer, m - 1, layer, m - 1)]
+        while stack:
+            lo, hi, opt_lo, opt_hi = stack.pop()
+            if lo > hi:
+                continue
+            mid = (lo + hi) // 2
+            starts = np.arange(max(opt_lo, layer), min(mid, opt_hi) + 1)
+            total = prev[starts - 1] + cost(starts, mid)
+            best = int(np.argmin(total))
+            cur[mid], arg[mid] = total[best], starts[best]
+            stack.append((lo, mid - 1, opt_lo, arg[mid]))
+            stack.append((mid + 1, hi, arg[mid], opt_hi))
+        prev = cur
+        split_points.append(arg)
+
+    cuts, end = [], m - 1
+    for arg in reversed(split_points):
+        start = arg[end]
+        cuts.append((v[start - 1] + v[start]) / 2)
+        end = start - 1
+    cuts = sorted(cuts) + [np.inf] * (n_classes - 1 - len(cuts))
+    return np.array(cuts)
+
+def quantile_breaks(values, quantiles=None):
+    quantiles = RISK_BANDS['QUANTILES'] if quantiles is None else quantiles
+    return np.nanquantile(np.asarray(values, dtype=np.float64), quantiles)
+
+@instrumented('fit_risk_bands')
+def fit_risk_bands(probabilities, method=None):
+    """Fits the AI risk band cut-points on a set of dropout probabilities."""
+    method = method or RISK_BANDS['METHOD']
+    if method == 'jenks':
+        return jenks_breaks(probabilities, RISK_BANDS['N_BANDS'])
+    if method == 'quantile':
+        return quantile_breaks(probabilities)
+    raise ValueError(f"Unknown risk band method '{method}'")
+
+def valid_risk_bands(cuts):
+    """True for N_BANDS - 1 finite, ascending cut-points; fits on too few distinct values are padded with inf."""
+    if cuts is None:
+        return False
+    cuts = np.asarray(cuts, dtype=np.float64)
+    return cuts.shape == (RISK_BANDS['N_BANDS'] - 1,) and bool(np.isfinite(cuts).all()) and bool((np.diff(cuts) >= 0).all())
+
+def can_calibrate(probabilities):
+    """Whether a batch is large and varied enough to fix the model's cut-points for all later batches."""
+    values = np.asarray(probabilities, dtype=np.float64)
+    values = values[~np.isnan(values)]
+    return values.size >= RISK_BANDS['MIN_CALIBRATION_ROWS'] and np.unique(values).size >= RISK_BANDS['N_BANDS']
+
+def calibrate_model(model, probabilities, method=None):
+    """
+    Fits risk band cut-points on a reference batch and sets them on the model as `risk_band_cuts_`.
+    Raises ValueError if the batch cannot support them; persist them with ModelRegistry.calibrate.
+    """
+    if not can_calibrate(probabilities):
+        raise ValueError(f"Cannot calibrate risk bands: the batch needs at least {RISK_BANDS['MIN_CALIBRATION_ROWS']} "
+                         f"students and {RISK_BANDS['N_BANDS']} distinct probabilities.")
+    cuts = fit_risk_bands(probabilities, method)
+    if not valid_risk_bands(cuts):
+        raise ValueError(f"Cannot calibrate risk bands: got cut-points {[float(c) for c in cuts]}.")
+    model.risk_band_cuts_ = cuts
+    return model.risk_band_cuts_
+
+def get_risk_bands(model, probabilities):
+    """The model's calibrated cut-points, or (with a warning) cut-points fitted on this batch alone."""
+    cuts = getattr(model, 'risk_band_cuts_', None)
+    if valid_risk_bands(cuts):
+        return np.asarray(cuts, dtype=np.float64)
+    report_warning("This model has no calibrated risk bands, so High/Medium/Low are fitted on this batch alone "
+                   "and can shift between batches. Calibrate it on a reference cohort to fix them.")
+    return fit_risk_bands(probabilities)
+
+@instrumented('assign_risk_levels', rows=len)
+def assign_risk_levels(probabilities, cut_points=None):
+    """
+    Maps probabilities to 'High'/'Medium'/'Low' with a searchsorted against fitted cut-points.
+    Without `cut_points` the bands are fitted on this batch alone.
+    """
+    if probabilities.empty: return pd.Series(pd.Categorical([], categories=RISK_LABELS), index=probabilities.index)
+    values = probabilities.to_numpy(dtype=np.float64)
+    cut_points = fit_risk_bands(values) if cut_points is None else np.asarray(cut_points)
+    codes = np.searchsorted(cut_points, values, side='right')
+    codes[np.isnan(values)] = -1
+    return pd.Series(pd.Categorical.from_codes(codes, categories=RISK_LABELS), index=probabilities.index)
@@ -1,11 +1,22 @@
 # utils/reporting.py
 
 import io
+import os
+import itertools
+import zipfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import math
 import numpy as np
-import matplotlib.pyplot as plt
+import pandas as pd
 from fpdf import FPDF
+from config import REPORTING
+from utils.peer_stats import compute_peer_stats, group_metrics
+from utils.instrumentation import instrumented, stage
 
 class PDF(FPDF):
+    report_first_page = 1  # page numbers restart here, so several reports can share one document
+
     def header(self):
         self.set_font('Arial', 'B', 15)
         self.cell(0, 10, 'Student Risk Analysis Report', 0, 1, 'C')
@@ -14,11 +25,85 @@ class PDF(FPDF):
     def footer(self):
         self.set_y(-15)
         self.set_font('Arial', 'I', 8)
-        self.cell(0, 10, f'Page {self.page_no()}', 0, 0, 'C')
+        self.cell(0, 10, f'Page {self.page_no() - self.report_first_page + 1}', 0, 0, 'C')
 
-def generate_ai_pdf(student_data, ai_peer_metrics):
-    pdf = PDF()
-    pdf.add_page()
+STUDENT_BAR_COLOR = (74, 144, 226)  # '#4A90E2'
+PEER_BAR_COLOR = (211, 211, 211)    # '#D3D3D3'
+
+def _nice_step(max_value, target_ticks=5):
+    raw = max(max_value, 1) / target_ticks
+    magnitude = 10 ** math.floor(math.log10(raw))
+    for factor in (1, 2, 2.5, 5, 10):
+        if raw <= factor * magnitude:
+            return factor * magnitude
+    return 10 * magnitude
+
+def _draw_peer_chart_matplotlib(pdf, title, metrics, student_values, peer_values, student_label, peer_label):
+    import matplotlib.pyplot as plt
+    x_labels = [m.replace('_', ' ').title() for m in metrics]
+    fig, ax = plt.subplots(figsize=(7, 4))
+    x = np.arange(len(metrics)); width = 0.35
+    ax.bar(x - width/2, student_values, width, label=student_label, color='#4A90E2')
+    ax.bar(x + width/2, peer_values, width, label=peer_label, color='#D3D3D3')
+    ax.set_ylabel('Scores / Percentage'); ax.set_title(title); ax.set_xticks(x); ax.set_xticklabels(x_labels); ax.legend(); fig.tight_layout()
+    buf = io.BytesIO(); fig.savefig(buf, format='png'); buf.seek(0); pdf.image(buf, x=pdf.get_x() + 25, w=160)
+    plt.close(fig)
+
+def _draw_peer_chart_vector(pdf, title, metrics, student_values, peer_values, student_label, peer_label):
+    """Draws the same grouped bar chart as the matplotlib path, using FPDF rects, lines and text only."""
+    x_labels = [m.replace('_', ' ').title() for m in metrics]
+    student_values = [0.0 if pd.isna(v) else float(v) for v in student_values]
+    peer_values = [0.0 if pd.isna(v) else float(v) for v in peer_values]
+    left, top, width, height = pdf.get_x() + 25, pdf.get_y(), 160, 91
+    plot_x, plot_y, plot_w, plot_h = left + 16, top + 10, width - 20, height - 24
+    step = _nice_step(max(student_values + peer_values))
+    y_max = step * max(1, math.ceil(max(student_values + peer_values) / step))
+
+    pdf.set_font('Arial', '', 11); pdf.set_xy(left, top + 1); pdf.cell(width, 6, title, 0, 0, 'C')
+    pdf.set_font('Arial', '', 8); pdf.set_draw_color(0, 0, 0); pdf.set_line_width(0.2)
+    ticks = int(round(y_max / step))
+    for t in range(ticks + 1):
+        value = t * step; y = plot_y + plot_h - plot_h * value / y_max
+        pdf.line(plot_x - 1, y, plot_x, y)
+        pdf.set_xy(plot_x - 13, y - 2); pdf.cell(11, 4, f"{value:g}", 0, 0, 'R')
+    with pdf.rotation(90, left + 3, plot_y + plot_h / 2):
+        pdf.set_xy(left + 3 - plot_h / 2, plot_y + plot_h / 2 - 2); pdf.cell(plot_h, 4, 'Scores / Percentage', 0, 0, 'C')
+    pdf.rect(plot_x, plot_y, plot_w, plot_h)
+
+    group_w = plot_w / len(metrics); bar_w = group_w * 0.35
+    for i, label in enumerate(x_labels):
+        center = plot_x + group_w * (i + 0.5)
+        for offset, value, color in ((-bar_w, student_values[i], STUDENT_BAR_COLOR), (0, peer_values[i], PEER_BAR_COLOR)):
+            bar_h = plot_h * min(max(value, 0), y_max) / y_max
+            pdf.set_fill_color(*color); pdf.rect(center + offset, plot_y + plot_h - bar_h, bar_w, bar_h, 'F')
+        pdf.line(center, plot_y + plot_h, center, plot_y + plot_h + 1)
+        pdf.set_xy(center - group_w / 2, plot_y + plot_h + 1.5); pdf.cell(group_w, 4, label, 0, 0, 'C')
+
+    # Legend sits under the axis labels so it can never cover a bar.
+    legend_y = plot_y + plot_h + 7
+    for column, (label, color) in enumerate(((student_label, STUDENT_BAR_COLOR), (peer_label, PEER_BAR_COLOR))):
+        x = plot_x + plot_w / 2 - 60 + column * 62
+        pdf.set_fill_color(*color); pdf.rect(x, legend_y + 0.8, 6, 2.6, 'F')
+        pdf.set_xy(x + 7, legend_y); pdf.cell(52, 4, str(label)[:45], 0, 0, 'L')
+    pdf.set_fill_color(255, 255, 255)
+    pdf.set_xy(pdf.l_margin, top + height)
+
+CHART_BACKENDS = {
+    'matplotlib': _draw_peer_chart_matplotlib,
+    'vector': _draw_peer_chart_vector,
+}
+
+def draw_peer_chart(pdf, title, metrics, student_values, peer_values, student_label, peer_label, chart_backend=None):
+    """Draws the "student vs peer group" bar chart at the current position with the chosen backend."""
+    backend = chart_backend or REPORTING['CHART_BACKEND']
+    if backend not in CHART_BACKENDS:
+        raise ValueError(f"Unknown chart backend '{backend}'")
+    CHART_BACKENDS[backend](pdf, title, metrics, student_values, peer_values, student_label, peer_label)
+
+def write_ai_report(pdf, student_data, ai_peer_metrics, chart_backend=None):
+    """Adds one student's AI-based report to `pdf`, starting on a new page."""
+    pdf.add_page()  # closes the previous report's last page, footer included
+    pdf.report_first_page = pdf.page_no()
     pdf.set_font('Arial', 'B', 14); pdf.cell(0, 10, f"AI-Based Report for: {student_data['Student Name']}", 0, 1)
     pdf.set_font('Arial', '', 12)
     pdf.cell(0, 8, f"Gender: {student_data['gender'].title()}", 0, 1)
@@ -34,20 +119,20 @@ def generate_ai_pdf(student_data, ai_peer_metrics):
     pdf.add_page()
     metrics = ['attendance', 'current_test_score']
     student_values = [student_data[m] for m in metrics]
-    x_labels = [m.replace('_', ' ').title() for m in metrics]
-    fig, ax = plt.subplots(figsize=(7, 4))
     ai_avg_values = [ai_peer_metrics[m] for m in metrics]
-    x = np.arange(len(metrics)); width = 0.35
-    ax.bar(x - width/2, student_values, width, label=student_data['Student Name'], color='#4A90E2')
-    ax.bar(x + width/2, ai_avg_values, width, label=f'Avg. for {risk_level} Risk', color='#D3D3D3')
-    ax.set_ylabel('Scores / Percentage'); ax.set_title('Performance vs. AI Peer Group'); ax.set_xticks(x); ax.set_xticklabels(x_labels); ax.legend(); fig.tight_layout()
-    buf = io.BytesIO(); fig.savefig(buf, format='png'); buf.seek(0); pdf.image(buf, x=pdf.get_x() + 25, w=160)
-    plt.close(fig)
-    return bytes(pdf.output())
+    draw_peer_chart(pdf, 'Performance vs. AI Peer Group', metrics, student_values, ai_avg_values,
+                    student_data['Student Name'], f'Avg. for {risk_level} Risk', chart_backend)
 
-def generate_rule_based_pdf(student_data, rule_peer_metrics):
+@instrumented('pdf_ai_report')
+def generate_ai_pdf(student_data, ai_peer_metrics, chart_backend=None):
     pdf = PDF()
-    pdf.add_page()
+    write_ai_report(pdf, student_data, ai_peer_metrics, chart_backend)
+    return bytes(pdf.output())
+
+def write_rule_based_report(pdf, student_data, rule_peer_metrics, chart_backend=None):
+    """Adds one student's rule-based report to `pdf`, starting on a new page."""
+    pdf.add_page()  # closes the previous report's last page, footer included
+    pdf.report_first_page = pdf.page_no()
     pdf.set_font('Arial', 'B', 14); pdf.cell(0, 10, f"Rule-Based Report for: {student_data['Student Name']}", 0, 1)
     pdf.set_font('Arial', '', 12)
     pdf.cell(0, 8, f"Gender: {student_data['gender'].title()}", 0, 1)
@@ -67,13 +152,151 @@ def generate_rule_based_pdf(student_data, rule_peer_metrics):
     pdf.add_page()
     metrics = ['attendance', 'current_test_score']
     student_values = [student_data[m] for m in metrics]
-    x_labels = [m.replace('_', ' ').title() for m in metrics]
-    fig, ax = plt.subplots(figsize=(7, 4))
     rule_avg_values = [rule_peer_metrics[m] for m in metrics]
-    x = np.arange(len(metrics)); width = 0.35
-    ax.bar(x - width/2, student_values, width, label=student_data['Student Name'], color='#4A90E2')
-    ax.bar(x + width/2, rule_avg_values, width, label=f'Avg. for {expert_status} Status', color='#D3D3D3')
-    ax.set_ylabel('Scores / Percentage'); ax.set_title('Performance vs. Rule-Based Peer Group'); ax.set_xticks(x); ax.set_xticklabels(x_labels); ax.legend(); fig.tight_layout()
-    buf = io.BytesIO(); fig.savefig(buf, format='png'); buf.seek(0); pdf.image(buf, x=pdf.get_x() + 25, w=160)
-    plt.close(fig)
-    return bytes(pdf.output())
\ No newline at end of file
+    draw_peer_chart(pdf, 'Performance vs. Rule-Based Peer Group', metrics, student_values, rule_avg_values,
+                    student_data['Student Name'], f'Avg. for {expert_status} Status', chart_backend)
+
+@instrumented('pdf_rule_report')
+def generate_rule_based_pdf(student_data, rule_peer_metrics, chart_backend=None):
+    pdf = PDF()
+    write_rule_based_report(pdf, student_data, rule_peer_metrics, chart_backend)
+    return bytes(pdf.output())
+
+REPORT_TYPES = {
+    'ai': (generate_ai_pdf, 'ai_risk_level'),
+    'rule': (generate_rule_based_pdf, 'expert_status'),
+}
+REPORT_WRITERS = {'ai': write_ai_report, 'rule': write_rule_based_report}
+REPORT_FILE_PREFIXES = {'ai': 'AI_Based', 'rule': 'Rule_Based'}
+
+def report_file_name(report_type, student_name):
+    return f"{REPORT_FILE_PREFIXES[report_type]}_Report_{str(student_name).replace(' ', '_')}.pdf"
+
+def _render_chunk(report_type, records, group_stats, chart_backend=None):
+    generate, group_column = REPORT_TYPES[report_type]
+    return [(position, generate(record, group_metrics(group_stats, record[group_column]), chart_backend)) for position, record in records]
+
+def _student_records(df):
+    records = df.to_dict('records')
+    for record in records:
+        if 'Student Name' not in record:
+            record['Student Name'] = record['Student_Name']
+    return records
+
+def generate_reports_parallel(df, report_type, peer_stats=None, max_workers=None, chunk_size=None, chart_backend=None):
+    """
+    Renders one report per row of `df` ('ai' or 'rule') across a process pool.
+    Yields (student, pdf_bytes) as chunks complete, where `student` is the row as a pd.Series.
+    Peer averages are read from `peer_stats` (see compute_peer_stats), computed over `df` if not given.
+    """
+    if report_type not in REPORT_TYPES:
+        raise ValueError(f"Unknown report type '{report_type}'")
+    if df.empty:
+        return
+    group_column = REPORT_TYPES[report_type][1]
+    if peer_stats is None:
+        peer_stats = compute_peer_stats(df, [group_column])
+    # Workers only need the statistics for this report's grouping column.
+    group_stats = peer_stats[group_column]
+    max_workers = max_workers or REPORTING['MAX_WORKERS'] or os.cpu_count() or 1
+    chunk_size = chunk_size or REPORTING['CHUNK_SIZE']
+    records = list(enumerate(_student_records(df)))
+    chunks = [records[i:i + chunk_size] for i in range(0, len(records), chunk_size)]
+
+    def as_student(position):
+        return df.iloc[position]
+
+    if max_workers == 1 or len(chunks) == 1:
+        for chunk in chunks:
+            for position, pdf_bytes in _render_chunk(report_type, chunk, group_stats, chart_backend):
+                yield as_student(position), pdf_bytes
+        return
+
+    context = multiprocessing.get_context(REPORTING['MP_START_METHOD'])
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(chunks)), mp_context=context) as executor:
+        pending = set()
+        chunk_iter = iter(chunks)
+        # Keep only a couple of chunks per worker in flight so results stream out in bounded memory.
+        for chunk in itertools.islice(chunk_iter, max_workers * 2):
+            pending.add(executor.submit(_render_chunk, report_type, chunk, group_stats, chart_backend))
+        while pending:
+            with stage('pdf_worker_wait') as frame:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                frame.rows = sum(len(future.result()) for future in done if future.exception() is None)
+            for future in done:
+                for position, pdf_bytes in future.result():
+                    yield as_student(position), pdf_bytes
+                next_chunk = next(chunk_iter, None)
+                if next_chunk is not None:
+                    pending.add(executor.submit(_render_chunk, report_type, next_chunk, group_stats, chart_backend))
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only, non-seekable sink that hands back whatever has been written since the last drain."""
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def stream_reports_zip(df, report_type, peer_stats=None, progress_callback=None, **render_options):
+    """
+    Yields a ZIP archive of one report per row of `df` as byte chunks, one chunk per finished report,
+    so the archive can be sent or written while later reports are still rendering. Only the reports
+    in flight in generate_reports_parallel are held in memory. `progress_callback(n_done, student)`
+    runs after each report.
+    """
+    sink = _ChunkSink()
+    names = set()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as archive:  # PDF streams are already compressed
+        for n_done, (student, pdf_bytes) in enumerate(generate_reports_parallel(df, report_type, peer_stats, **render_options), 1):
+            name = report_file_name(report_type, student['Student_Name'] if 'Student_Name' in student else student['Student Name'])
+            if name in names:
+                name = name.replace('.pdf', f'_{n_done}.pdf')
+            names.add(name)
+            archive.writestr(name, pdf_bytes)
+            if progress_callback:
+                progress_callback(n_done, student)
+            yield sink.drain()
+    yield sink.drain()
+
+def write_reports_zip(df, report_type, fh, peer_stats=None, progress_callback=None, **render_options):
+    """Writes the archive from stream_reports_zip to a binary file handle."""
+    for chunk in stream_reports_zip(df, report_type, peer_stats, progress_callback, **render_options):
+        fh.write(chunk)
+
+@instrumented('pdf_merged_report')
+def write_merged_pdf(df, report_type, fh, peer_stats=None, progress_callback=None, chart_backend=None):
+    """
+    Writes one PDF holding every row's report, each starting on a new page with its own page numbers.
+    All reports share a single PDF object, so fonts and the header/footer are set up once. FPDF only
+    serializes a finished document, so pages accumulate in memory until the end; the vector chart
+    backend (REPORTING['MERGED_CHART_BACKEND']) keeps that small by avoiding one image per student.
+    """
+    if report_type not in REPORT_WRITERS:
+        raise ValueError(f"Unknown report type '{report_type}'")
+    group_column = REPORT_TYPES[report_type][1]
+    if peer_stats is None:
+        peer_stats = compute_peer_stats(df, [group_column])
+    group_stats = peer_stats[group_column]
+    write_report = REPORT_WRITERS[report_type]
+    chart_backend = chart_backend or REPORTING['MERGED_CHART_BACKEND']
+    pdf = PDF()
+    for n_done, record in enumerate(_student_records(df), 1):
+        write_report(pdf, record, group_metrics(group_stats, record[group_column]), chart_backend)
+        if progress_callback:
+            progress_callback(n_done, record)
+    fh.write(pdf.output())
@@ -0,0 +1,80 @@
+# utils/runtime.py
+
+"""
+Keeps the utils modules usable outside Streamlit. Errors and secrets go through here:
+inside a running dashboard they map to st.error/st.stop and st.secrets; in scripts and
+the CLI errors raise PipelineError and secrets come from environment variables.
+Streamlit is never imported from this module.
+"""
+
+import os
+import sys
+import logging
+
+logger = logging.getLogger("student_dashboard")
+
+class PipelineError(Exception):
+    """A scoring or reporting step could not continue (bad input, missing column, ...)."""
+
+class StreamlitReporter:
+    """Shows messages in the dashboard, as the utils modules always have."""
+    def error(self, message):
+        sys.modules['streamlit'].error(message)
+
+    def warning(self, message):
+        sys.modules['streamlit'].warning(message)
+
+    def stop(self):
+        sys.modules['streamlit'].stop()
+
+class RaisingReporter:
+    """Logs warnings and raises PipelineError on errors."""
+    def error(self, message):
+        raise PipelineError(message)
+
+    def warning(self, message):
+        logger.warning(message)
+
+    def stop(self):
+        raise PipelineError("Pipeline stopped.")
+
+_reporter = None
+
+def _streamlit_running():
+    if 'streamlit' not in sys.modules:
+        return False
+    try:
+        from streamlit import runtime
+        return runtime.exists()
+    except Exception:
+        return False
+
+def set_reporter(reporter):
+    """Overrides where errors and warnings go; pass None to restore the default."""
+    global _reporter
+    _reporter = reporter
+
+def get_reporter():
+    if _reporter is not None:
+        return _reporter
+    return StreamlitReporter() if _streamlit_running() else RaisingReporter()
+
+def report_error(message):
+    get_reporter().error(message)
+
+def report_warning(message):
+    get_reporter().warning(message)
+
+def stop():
+    get_reporter().stop()
+
+def get_secret(name, default=None):
+    """Reads a secret from secrets.toml inside the dashboard, falling back to the NAME environment variable."""
+    if _streamlit_running():
+        secrets = sys.modules['streamlit'].secrets
+        try:
+            if name in secrets:
+                return secrets[name]
+        except Exception:
+            pass
+    return os.environ.get(name.upper(), default)
@@ -0,0 +1,75 @@
+# utils/scoring_cache.py
+
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from config import SCORING_CACHE
+
+class ScoringCache:
+    """
+    LRU of per-student results (dropout probability and expert rule index) keyed by a 64-bit hash
+    of the row's input columns, salted with the model hash and the rule-set fingerprint so a new
+    model or changed thresholds never reuse stale results.
+    """
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries or SCORING_CACHE['MAX_ENTRIES']
+        self._entries = OrderedDict()  # key -> (probability, rule_index)
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+        self.last_hits = self.last_misses = 0
+
+    @staticmethod
+    def row_keys(data, columns, *salt_parts):
+        """One uint64 key per row from the values in `columns` and the salt."""
+        salt = int.from_bytes(hashlib.sha256("|".join(map(str, salt_parts)).encode()).digest()[:8], 'little')
+        columns = [col for col in columns if col in data.columns]
+        row_hashes = pd.util.hash_pandas_object(data[columns], index=False).to_numpy()
+        return row_hashes ^ np.uint64(salt)
+
+    def lookup(self, keys):
+        """(found mask, probabilities, rule indices) for `keys`; entries that are not found are NaN / -1."""
+        n = len(keys)
+        found = np.zeros(n, dtype=bool)
+        probabilities = np.full(n, np.nan)
+        rule_index = np.full(n, -1, dtype=np.int16)
+        with self._lock:
+            entries = self._entries
+            for i, key in enumerate(keys.tolist()):
+                entry = entries.get(key)
+                if entry is not None:
+                    entries.move_to_end(key)
+                    found[i] = True
+                    probabilities[i], rule_index[i] = entry
+            hits = int(found.sum())
+            self.last_hits, self.last_misses = hits, n - hits
+            self.hits += hits
+            self.misses += n - hits
+        return found, probabilities, rule_index
+
+    def store(self, keys, probabilities, rule_index):
+        with self._lock:
+            entries = self._entries
+            for key, probability, index in zip(keys.tolist(), probabilities.tolist(), rule_index.tolist()):
+                entries[key] = (probability, index)
+                entries.move_to_end(key)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+
+    def stats(self):
+        return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                'last_hits': self.last_hits, 'last_misses': self.last_misses}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+_cache = None
+
+def get_scoring_cache():
+    """The process-wide scoring cache."""
+    global _cache
+    if _cache is None:
+        _cache = ScoringCache()
+    return _cache
@@ -0,0 +1,61 @@
+# utils/table_view.py
+
+import io
+import numpy as np
+from config import TABLE_VIEW
+
+DISPLAY_NAMES = {
+    'Student_Name': 'Student Name', 'ai_risk_level': 'AI Risk', 'dropout_probability': 'AI Probability',
+    'expert_status': 'Expert Status', 'expert_reason': 'Expert Reason',
+    'current_test_score': 'Test Score', 'attendance': 'Attendance (%)', 'fees': 'Fee Status',
+    'gender': 'Gender', 'previous_test_score': 'Previous Score'
+}
+
+def sorted_positions(df, sort_by=None, ascending=True):
+    """Row positions of `df` in display order; only the sort column is touched, never the whole frame."""
+    if not sort_by or sort_by not in df.columns:
+        return np.arange(len(df))
+    column = df[sort_by].reset_index(drop=True)
+    return column.sort_values(ascending=ascending, kind='stable', na_position='last').index.to_numpy()
+
+def format_for_display(page_df):
+    """Formats and renames the columns of an already-sliced page for display."""
+    page_df = page_df.copy()
+    if 'dropout_probability' in page_df.columns:
+        page_df['dropout_probability'] = page_df['dropout_probability'].map('{:.2%}'.format)
+    if 'fees' in page_df.columns:
+        page_df['fees'] = np.where(page_df['fees'] == 1, 'Paid', 'Unpaid')
+    return page_df.rename(columns={k: v for k, v in DISPLAY_NAMES.items() if k in page_df.columns})
+
+def table_page(df, columns, sort_by=None, ascending=True, page=1, page_size=None):
+    """
+    One page of `df` ready to display: sorted, limited to `columns` and formatted.
+    Returns (page_df, total_rows, n_pages); `page` is 1-based and clamped to the valid range.
+    """
+    page_size = page_size or TABLE_VIEW['DEFAULT_PAGE_SIZE']
+    total_rows = len(df)
+    n_pages = max(1, -(-total_rows // page_size))
+    page = min(max(1, page), n_pages)
+    positions = sorted_positions(df, sort_by, ascending)[(page - 1) * page_size:page * page_size]
+    return format_for_display(df.iloc[positions][columns]), total_rows, n_pages
+
+def export_bytes(df, fmt, chunk_rows=None):
+    """
+    `df` as a CSV or Parquet file for a download button, encoded EXPORT_CHUNK_ROWS rows at a time into
+    one buffer, so only the finished file and one chunk are in memory (no full-size text or Arrow copy).
+    """
+    chunk_rows = chunk_rows or TABLE_VIEW['EXPORT_CHUNK_ROWS']
+    buffer = io.BytesIO()
+    if fmt == 'csv':
+        for start in range(0, max(len(df), 1), chunk_rows):
+            buffer.write(df.iloc[start:start + chunk_rows].to_csv(index=False, header=start == 0).encode('utf-8'))
+    elif fmt == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        schema = pa.Schema.from_pandas(df, preserve_index=False)  # infers types over every row without converting them
+        with pq.ParquetWriter(buffer, schema) as writer:
+            for start in range(0, len(df), chunk_rows):
+                writer.write_table(pa.Table.from_pandas(df.iloc[start:start + chunk_rows], schema=schema, preserve_index=False))
+    else:
+        raise ValueError(f"Unknown export format '{fmt}'")
+    return buffer.getvalue()  # returns the buffer's own bytes object, not a copy